@@ -1,40 +1,52 @@
 import asyncio
 import contextlib
+from collections import OrderedDict, defaultdict
+import functools
 import datetime
 import time
 import threading
 import os
+import socket
 import typing
 import json
 import logging
+import orjson
 import uvicorn
 from starlette.applications import Starlette
 from starlette.requests import Request
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, PlainTextResponse, Response
 from starlette.exceptions import HTTPException
 from starlette.middleware import Middleware
 from starlette.middleware.cors import CORSMiddleware
-from starlette.routing import Route
+from starlette.routing import Route, WebSocketRoute
+from starlette.websockets import WebSocketDisconnect
 from asgi_logger import AccessLoggerMiddleware
 
-from db import Database
+import metrics
+from db import AsyncDatabase, format_prices, CANDLE_RESOLUTIONS
+from events import Message, next_message
+from ticker import Ticker, WINDOW
+
+
+JSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+
+def dumps(value):
+    '''
+    Compact UTF-8 JSON. datetimes are written natively as RFC 3339, numpy
+    arrays and scalars as plain numbers, and Decimal as its string, as before.
+    '''
+    return orjson.dumps(value, default=str, option=JSON_OPTIONS)
+
+
+ENVELOPE = b'{"code":200,"msg":"","data":'
 
 
 class HJSONResponse(JSONResponse):
     def render(self, content: typing.Any) -> bytes:
-        content = dict(
-            code=self.status_code,
-            msg='',
-            data=content,
-        )
-        return json.dumps(
-            content,
-            ensure_ascii=False,
-            allow_nan=True,
-            indent=None,
-            separators=(",", ":"),
-            default=str,
-        ).encode("utf-8")
+        # {"code": status, "msg": "", "data": content}, with the head pre-encoded
+        head = ENVELOPE if self.status_code == 200 else b'{"code":%d,"msg":"","data":' % self.status_code
+        return head + dumps(content) + b'}'
 
 
 class Server(uvicorn.Server):
@@ -54,6 +66,92 @@ class Server(uvicorn.Server):
             thread.join()
 
 
+def parse_time(value):
+    if value.isdigit():
+        return datetime.datetime.fromtimestamp(int(value), datetime.timezone.utc)
+    return datetime.datetime.fromisoformat(value)
+
+
+PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 1000
+
+
+def page_params(request):
+    # keyset pagination: rows with id > after, ascending, at most limit of them
+    limit = int(request.query_params.get('limit', PAGE_LIMIT))
+    after = request.query_params.get('after')
+    return min(max(limit, 1), MAX_PAGE_LIMIT), None if after is None else int(after)
+
+
+class ResponseCache:
+    '''
+    Responses of the read-only routes, keyed by path and sorted query params.
+    An entry lives for its route's ttl, and beyond max_entries the least
+    recently used ones are evicted. Concurrent misses for one key wait on a
+    single computation. invalidate bumps the generation of a path when the bus
+    reports a change: entries and computations of an older generation are
+    never served again, and LRU eviction drops them eventually.
+    '''
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # key -> (generation, expires, (status, media type, body))
+        self.inflight = {} # (key, generation) -> task computing the response
+        self.generations = defaultdict(int) # path -> generation
+
+    def invalidate(self, *paths):
+        for path in paths:
+            self.generations[path] += 1
+
+    async def respond(self, request, ttl, route):
+        key = (request.url.path, tuple(sorted(request.query_params.multi_items())))
+        generation = self.generations[key[0]]
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == generation and entry[1] > time.monotonic():
+            self.entries.move_to_end(key)
+            metrics.API_CACHE_REQUESTS.inc(route=key[0], result='hit')
+            status, media_type, body = entry[2]
+        else:
+            task = self.inflight.get((key, generation))
+            metrics.API_CACHE_REQUESTS.inc(route=key[0], result='miss' if task is None else 'shared')
+            if task is None:
+                task = self.inflight[key, generation] = asyncio.create_task(self.fill(key, generation, ttl, route, request))
+            # a client going away must not cancel the computation the others wait on
+            status, media_type, body = await asyncio.shield(task)
+        return Response(body, status_code=status, media_type=media_type)
+
+    async def fill(self, key, generation, ttl, route, request):
+        try:
+            response = await route(request)
+        finally:
+            del self.inflight[key, generation]
+        value = (response.status_code, response.media_type, response.body)
+        if response.status_code == 200:
+            self.entries[key] = (generation, time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return value
+
+
+cache = ResponseCache(int(os.environ.get("API_CACHE_SIZE", 1024)))
+# cached routes whose answers a bus message makes stale
+INVALIDATES = {
+    Message.Type.DatabaseBlockAdded: ('/api/price',),
+    Message.Type.DatabaseTradesAdded: ('/api/price', '/api/summary', '/api/history'),
+    Message.Type.DealerDepthUpdated: ('/api/price',),
+}
+
+
+def cached(ttl):
+    '''Serve a read-only route from cache, recomputing it at most every ttl seconds.'''
+    def wrap(route):
+        @functools.wraps(route)
+        async def cached_route(request):
+            return await cache.respond(request, ttl, route)
+        return cached_route
+    return wrap
+
+
 async def index_route(request):
     return HJSONResponse({'hello': 'world'})
 
@@ -80,13 +178,19 @@ async def order_route(request):
     if tm_to:
         tm_to = datetime.datetime.fromtimestamp(int(tm_to), datetime.timezone.utc)
         filter['tm_to'] = tm_to
-    orders = db.load_valid_orders(filter)
+    limit, after = page_params(request)
+    if after is not None:
+        filter['after_id'] = after
+    orders = await db.load_valid_orders(filter, limit=limit)
     return HJSONResponse(orders)
 
 
+@cached(ttl=1)
 async def price_route(request):
     symbol = request.query_params.get('symbol')
-    prices = db.load_prices(symbol=symbol)
+    if symbol in token_ids and token_ids[symbol] in depth:
+        return HJSONResponse(depth[token_ids[symbol]][1])
+    prices = await db.load_prices(symbol=symbol)
     return HJSONResponse(prices)
 
 
@@ -103,10 +207,21 @@ async def trade_route(request):
             onchain = True
         else:
             onchain = False
-    trades = db.load_trades(symbol=symbol, tm_from=tm_from, tm_to=tm_to, onchain=onchain, addr=addr, order_id=order_id, token_id=token_id)
+    # asyncpg does not coerce strings, so convert the typed filters here
+    if tm_from:
+        tm_from = parse_time(tm_from)
+    if tm_to:
+        tm_to = parse_time(tm_to)
+    if order_id is not None:
+        order_id = int(order_id)
+    if token_id is not None:
+        token_id = int(token_id)
+    limit, after = page_params(request)
+    trades = await db.load_trades(symbol=symbol, tm_from=tm_from, tm_to=tm_to, onchain=onchain, addr=addr, order_id=order_id, token_id=token_id, limit=limit, after=after)
     return HJSONResponse(trades)
 
 
+@cached(ttl=5)
 async def history_route(request):
     symbol = request.query_params.get('symbol')
     tm_from = request.query_params.get('from')
@@ -118,14 +233,17 @@ async def history_route(request):
         tm_to = datetime.datetime.fromtimestamp(int(tm_to), datetime.timezone.utc)
     if resolution.isdigit():
         resolution += 'Min'
-    history = db.load_history(symbol=symbol, tm_from=tm_from, tm_to=tm_to, resolution=resolution)
+    history = await db.load_candles(symbol=symbol, tm_from=tm_from, tm_to=tm_to, resolution=resolution)
     history['nextTime'] = request.query_params.get('from')
     return HJSONResponse(history)
 
 
+@cached(ttl=1)
 async def summary_route(request):
     symbol = request.query_params.get('symbol')
-    data = db.summary_trade(symbol)
+    if None in tickers and (not symbol or symbol in token_ids):
+        return HJSONResponse(tickers[token_ids[symbol] if symbol else None].summary())
+    data = await db.summary_trade(symbol)
     return HJSONResponse(data)
 
 
@@ -152,11 +270,164 @@ async def symbol_route(request):
         ]})
 
 
+@cached(ttl=3600)
 async def symbols_route(request):
-    tokens = db.load_tokens()
+    tokens = await db.load_tokens()
     return HJSONResponse(tokens)
 
 
+async def metrics_route(request):
+    # this process's metrics, plus the snapshots the other role processes publish in EXPLORER_MODE=processes
+    return PlainTextResponse(metrics.render(remote_metrics.values()), media_type='text/plain; version=0.0.4')
+
+
+class MetricsMiddleware:
+    '''Latency and status of every http request, labelled with the path of its route.'''
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # the router puts the matched endpoint into the scope
+            route = route_paths.get(scope.get('endpoint'), 'unmatched')
+            metrics.HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, route=route)
+            metrics.HTTP_REQUESTS.inc(route=route, status=status)
+
+
+class StreamHub:
+    '''
+    Fans bus events out to websocket clients. Subscriptions are keyed by
+    (channel, token_id) or ('candles', token_id, seconds). Every client owns a
+    bounded queue drained by its own connection, so one slow client never
+    delays the others; a client that falls max_queue messages behind is
+    disconnected and has to resubscribe.
+    '''
+
+    def __init__(self, max_queue=1000):
+        self.max_queue = max_queue
+        self.subscribers = defaultdict(set) # key -> {client queue}
+        self.keys = {} # client queue -> (websocket, {key})
+
+    def connect(self, websocket):
+        queue = asyncio.Queue(self.max_queue)
+        self.keys[queue] = (websocket, set())
+        return queue
+
+    def disconnect(self, queue):
+        _, keys = self.keys.pop(queue, (None, ()))
+        for key in keys:
+            self.unsubscribe(queue, key)
+
+    def subscribe(self, queue, key):
+        self.subscribers[key].add(queue)
+        self.keys[queue][1].add(key)
+
+    def unsubscribe(self, queue, key):
+        self.subscribers[key].discard(queue)
+        if not self.subscribers[key]:
+            del self.subscribers[key]
+        if queue in self.keys:
+            self.keys[queue][1].discard(key)
+
+    def wants(self, key):
+        return key in self.subscribers
+
+    def publish(self, key, message):
+        for queue in list(self.subscribers.get(key, ())):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                websocket, _ = self.keys[queue]
+                self.disconnect(queue)
+                asyncio.create_task(websocket.close(code=1013))
+
+
+hub = StreamHub()
+CHANNELS = ('trades', 'depth', 'candles', 'ticker')
+
+
+def stream_key(request):
+    '''Subscription key for a {"channel", "symbol"[, "resolution"]} request, or None.'''
+    channel = request.get('channel')
+    token_id = token_ids.get(request.get('symbol'))
+    if channel not in CHANNELS or token_id is None:
+        return None
+    if channel != 'candles':
+        return (channel, token_id)
+    resolution = str(request.get('resolution', '1'))
+    if resolution.isdigit():
+        resolution += 'Min'
+    seconds = CANDLE_RESOLUTIONS.get(resolution)
+    return None if seconds is None else (channel, token_id, seconds)
+
+
+async def stream_snapshot(key):
+    # state a client starts from; later messages on the channel are incremental
+    if key[0] == 'depth':
+        if key[1] in depth:
+            version, ladder, _ = depth[key[1]]
+            return dict(version=version, levels=ladder)
+        return dict(version=None, levels=await db.load_prices(symbol=symbols[key[1]]))
+    if key[0] == 'ticker':
+        return tickers[key[1]].summary() if None in tickers else await db.summary_trade(symbols[key[1]])
+    return None
+
+
+async def send_stream(websocket, queue):
+    while True:
+        await websocket.send_text(dumps(await queue.get()).decode())
+
+
+async def ws_route(websocket):
+    '''
+    Streaming api. Clients send {"op": "subscribe" | "unsubscribe", "channel":
+    "trades" | "depth" | "candles" | "ticker", "symbol": ..., "resolution": ...}
+    and receive {"channel", "symbol", "type": "snapshot" | "update", "data"}.
+    '''
+    await websocket.accept()
+    queue = hub.connect(websocket)
+    sender = asyncio.create_task(send_stream(websocket, queue))
+    try:
+        while True:
+            try:
+                request = json.loads(await websocket.receive_text())
+            except ValueError:
+                request = {}
+            if not isinstance(request, dict):
+                request = {}
+            if request.get('symbol') is not None and request.get('symbol') not in token_ids:
+                await load_token_ids()
+            key = stream_key(request)
+            op = request.get('op')
+            if key is None or op not in ('subscribe', 'unsubscribe'):
+                queue.put_nowait(dict(type='error', request=request, msg='bad subscription'))
+                continue
+            if op == 'unsubscribe':
+                hub.unsubscribe(queue, key)
+                continue
+            hub.subscribe(queue, key)
+            snapshot = await stream_snapshot(key)
+            queue.put_nowait(dict(channel=key[0], symbol=symbols[key[1]], type='snapshot', data=snapshot))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        hub.disconnect(queue)
+        sender.cancel()
+
+
 async def bad_request(request: Request, exc: HTTPException):
     return HJSONResponse({}, status_code=400)
 
@@ -179,19 +450,103 @@ routes = [
     Route("/api/time", time_route),
     Route("/api/symbol", symbol_route),
     Route("/api/symbols", symbols_route),
+    WebSocketRoute("/api/ws", ws_route),
+    Route("/metrics", metrics_route),
 ]
 
+route_paths = {route.endpoint: route.path for route in routes}
+
 exc_handlers = {
     400: bad_request,
     404: not_found,
     550: internal_error,
 }
 
+async def load_token_ids():
+    for token in await db.load_tokens():
+        token_ids[token['symbol']] = token['id']
+        symbols[token['id']] = token['symbol']
+
+
+def depth_diff(old, new):
+    # levels whose quantity changed, 0 for levels that are gone
+    diff = [dict(side=side, price=float(price), quantity=quantity) for (side, price), quantity in new.items() if old.get((side, price)) != quantity]
+    diff += [dict(side=side, price=float(price), quantity=0) for (side, price) in old if (side, price) not in new]
+    return diff
+
+
+async def track_events(queue):
+    # keep the newest depth ladder per token and fan matching results out to websocket clients
+    while True:
+        msg = await next_message(queue, 60)
+        if msg is None:
+            continue
+        data = msg.data
+        if msg.type == Message.Type.MetricsUpdated:
+            if data['pid'] != os.getpid():
+                remote_metrics[data['pid']] = data['metrics']
+        elif msg.type == Message.Type.DealerDepthUpdated:
+            token_id = data['token_id']
+            if token_id not in symbols:
+                await load_token_ids()
+            version, _, levels = depth.get(token_id, (-1, None, {}))
+            if data['version'] < version:
+                continue
+            new_levels = {('ask', price): quantity for quantity, price in data['asks']}
+            new_levels.update({('bid', price): quantity for quantity, price in data['bids']})
+            depth[token_id] = (data['version'], format_prices(data['asks'], data['bids']), new_levels)
+            diff = depth_diff(levels, new_levels)
+            if diff and hub.wants(('depth', token_id)):
+                hub.publish(('depth', token_id), dict(channel='depth', symbol=symbols[token_id], type='update', data=dict(version=data['version'], levels=diff)))
+        elif msg.type == Message.Type.DatabaseTradesAdded:
+            if any(trade['token_id'] not in symbols for trade in data['trades']):
+                await load_token_ids()
+            for trade in data['trades']:
+                tickers[trade['token_id']].add(trade)
+                tickers[None].add(trade)
+                key = ('trades', trade['token_id'])
+                if hub.wants(key):
+                    hub.publish(key, dict(channel='trades', symbol=symbols[trade['token_id']], type='update', data=dict(
+                        id=trade['id'], price=float(trade['price']), quantity=trade['quantity'], time=int(trade['created_at'].timestamp()))))
+            for bar in data.get('candles', ()):
+                key = ('candles', bar['token_id'], bar['resolution'])
+                if hub.wants(key):
+                    hub.publish(key, dict(channel='candles', symbol=symbols[bar['token_id']], type='update', data=dict(
+                        t=bar['time'], o=float(bar['open']), h=float(bar['high']), l=float(bar['low']), c=float(bar['close']), v=bar['volume'])))
+            for token_id in {trade['token_id'] for trade in data['trades']}:
+                key = ('ticker', token_id)
+                if hub.wants(key):
+                    hub.publish(key, dict(channel='ticker', symbol=symbols[token_id], type='update', data=tickers[token_id].summary()))
+        # after the state above is updated, so a recomputed answer never predates the message
+        cache.invalidate(*INVALIDATES.get(msg.type, ()))
+
+
+token_ids = {} # symbol -> token id
+symbols = {} # token id -> symbol
+depth = {} # token id -> (version, /api/price ladder, {(side, price): quantity})
+tickers = defaultdict(Ticker) # token id (None for all symbols) -> Ticker, only filled while the bus feeds trades
+remote_metrics = {} # pid -> metrics.snapshot() of another role process
+
+
 async def startup():
     async def noop(_): pass
     psqlurl = os.environ.get("PSQLURL")
-    global db
-    db = Database(psqlurl)
+    global db, events_task
+    db = AsyncDatabase(psqlurl)
+    bus = getattr(app.state, 'bus', None)
+    if bus is not None:
+        queue = bus.subscribe(Message.Type.DealerDepthUpdated, Message.Type.DatabaseTradesAdded, Message.Type.DatabaseBlockAdded, Message.Type.MetricsUpdated)
+        # seed the tickers after subscribing, trades delivered twice are skipped by id
+        await load_token_ids()
+        tickers[None] = Ticker()
+        for trade in await db.load_recent_trades(datetime.datetime.now(datetime.timezone.utc) - WINDOW):
+            tickers[trade['token_id']].add(trade)
+            tickers[None].add(trade)
+        events_task = asyncio.create_task(track_events(queue))
+
+
+async def shutdown():
+    await db.close()
 
 
 AccessLoggerMiddleware.DEFAULT_FORMAT = '\033[92mACCESS\033[0m: \033[94m%(client_addr)s\033[0m - - %(t)s \033[96m"%(request_line)s"\033[0m \033[93m%(s)s\033[0m %(B)s "%(f)s" "%(a)s" %(L)s'
@@ -199,12 +554,14 @@ app = Starlette(
     debug=True if os.environ.get("DEBUG") else False,
     routes=routes,
     on_startup=[startup],
+    on_shutdown=[shutdown],
     exception_handlers=exc_handlers,
-    middleware=[Middleware(AccessLoggerMiddleware), Middleware(CORSMiddleware, allow_origins=['*'])]
+    middleware=[Middleware(MetricsMiddleware), Middleware(AccessLoggerMiddleware), Middleware(CORSMiddleware, allow_origins=['*'])]
 )
 
 
-async def run():
+async def run(bus=None):
+    app.state.bus = bus
     config = uvicorn.Config("api:app", reload=True, log_level="info", host=os.environ.get('HOST', '127.0.0.1'), port=int(os.environ.get("PORT", 8000)))
     logging.getLogger("uvicorn.access").handlers = []
     server = Server(config=config)
@@ -214,6 +571,22 @@ async def run():
             await asyncio.sleep(3600)
 
 
+async def serve(bus=None):
+    '''
+    Run one api worker on this process's event loop. Every worker binds its own
+    SO_REUSEPORT socket on HOST:PORT, so the kernel spreads connections across
+    the workers.
+    '''
+    app.state.bus = bus
+    config = uvicorn.Config(app, log_level="info")
+    logging.getLogger("uvicorn.access").handlers = []
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((os.environ.get('HOST', '127.0.0.1'), int(os.environ.get("PORT", 8000))))
+    await Server(config=config).serve(sockets=[sock])
+
+
 if __name__ == '__main__':
     from dotenv import load_dotenv
     load_dotenv()
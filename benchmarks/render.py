@@ -0,0 +1,135 @@
+#! /usr/bin/python
+'''
+Render benchmark of the api's response envelope.
+
+Seeded payloads shaped by the db formatters (orders and trades as
+/api/order and /api/trade return them, a price ladder and a history of
+numpy columns) are rendered by HJSONResponse and by the json.dumps render
+it replaced. The report gives ms per render for both as JSON, so runs can
+be compared across commits.
+
+usage:
+    python benchmarks/render.py         # 1000 orders/trades, 10000 bars
+    python benchmarks/render.py -r 5000 -b 50000 -n 20
+'''
+from __future__ import print_function
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from decimal import Decimal
+from types import SimpleNamespace
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import numpy as np
+from api import HJSONResponse
+from db import format_prices
+from db.db import _format_history, _format_orders, _format_trades
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def json_render(status, content):
+    # HJSONResponse.render before orjson
+    return json.dumps(dict(code=status, msg='', data=content), ensure_ascii=False, allow_nan=True, indent=None,
+                      separators=(",", ":"), default=str).encode("utf-8")
+
+
+def timestamps(rand, nb_rows):
+    start = datetime.datetime(2023, 11, 1, tzinfo=datetime.timezone.utc)
+    return sorted(start + datetime.timedelta(seconds=rand.randint(0, 30 * 86400), microseconds=rand.randint(0, 999999)) for _ in range(nb_rows))
+
+
+def orders(nb_rows, seed):
+    rand = random.Random(seed)
+    rows = []
+    for i, created_at in enumerate(timestamps(rand, nb_rows)):
+        origin_quantity = rand.randint(1, 1000)
+        quantity = rand.randint(0, origin_quantity)
+        price = Decimal(rand.randint(90, 110))
+        rows.append(SimpleNamespace(id=i, type='limit', side=rand.choice(('ask', 'bid')), quantity=quantity, origin_quantity=origin_quantity,
+                                    price=price, sum_price=price * (origin_quantity - quantity), addr=f'aleo1{rand.getrandbits(200):x}',
+                                    height=i // 3, created_at=created_at, updated_at=created_at, status=rand.choice(('todo', 'done')),
+                                    symbol='TK1-LEO', token_id=1))
+    return _format_orders(rows)
+
+
+def trades(nb_rows, seed):
+    rand = random.Random(seed)
+    rows = []
+    for i, created_at in enumerate(timestamps(rand, nb_rows)):
+        party = {}
+        for n, side in ((1, 'ask'), (2, 'bid')):
+            party.update({f'party{n}_id': 2 * i + n, f'party{n}_side': side, f'party{n}_price': Decimal(rand.randint(90, 110)),
+                          f'party{n}_addr': f'aleo1{rand.getrandbits(200):x}', f'party{n}_quantity': rand.randint(0, 50),
+                          f'party{n}_origin_quantity': 50})
+        rows.append(SimpleNamespace(id=i, price=Decimal(rand.randint(90, 110)), quantity=float(rand.randint(1, 50)), onchain=False,
+                                    settlement='submitted', created_at=created_at, updated_at=created_at, symbol='TK1-LEO', **party))
+    return _format_trades(rows)
+
+
+def prices(seed):
+    rand = random.Random(seed)
+    levels = [(rand.randint(1, 5000), Decimal(price)) for price in range(120, 80, -1)]
+    return format_prices(levels[:20], levels[20:])
+
+
+def history(nb_bars, seed):
+    rand = np.random.default_rng(seed)
+    close = 100 + rand.standard_normal(nb_bars).cumsum()
+    columns = (1698796800 + 300 * np.arange(nb_bars), close + rand.standard_normal(nb_bars), close + 2, close - 2, close,
+               rand.integers(0, 500, nb_bars).astype(float))
+    return _format_history(columns)
+
+
+def measure(render, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        render()
+    return round((time.perf_counter() - start) / repeat * 1e3, 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-r', '--rows', type=int, default=1000, help='orders and trades per payload')
+    parser.add_argument('-b', '--bars', type=int, default=10000, help='bars in the history payload')
+    parser.add_argument('-n', '--repeat', type=int, default=50, help='renders per measurement')
+    parser.add_argument('-s', '--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    history_payload = history(args.bars, args.seed)
+    payloads = {
+        'orders': (orders(args.rows, args.seed),) * 2,
+        'trades': (trades(args.rows, args.seed),) * 2,
+        'prices': (prices(args.seed),) * 2,
+        # json.dumps takes lists, as the history path returned before
+        'history': (history_payload, {name: column.tolist() if name != 's' else column for name, column in history_payload.items()}),
+    }
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'rows': args.rows,
+        'bars': args.bars,
+        'payloads': {},
+    }
+    for name, (payload, lists) in payloads.items():
+        orjson_ms = measure(lambda: HJSONResponse(payload).body, args.repeat)
+        json_ms = measure(lambda: json_render(200, lists), args.repeat)
+        report['payloads'][name] = dict(orjson_ms=orjson_ms, json_ms=json_ms, speedup=round(json_ms / orjson_ms, 1),
+                                        bytes=len(HJSONResponse(payload).body))
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,42 +1,153 @@
+import datetime
+import json
 import os
 import aiohttp
 import asyncio
+import time
+import metrics
 from db import Database
+from events import Message, next_message
 
 
-async def run():
+TIMEOUT = aiohttp.ClientTimeout(total=60)
+
+
+def transaction_id(body):
+    # the execute endpoint answers with the id of the transaction it broadcast
+    try:
+        value = json.loads(body)
+    except ValueError:
+        value = body.strip()
+    if isinstance(value, dict):
+        value = value.get('transaction_id') or value.get('id')
+    return value if isinstance(value, str) and value else None
+
+
+async def submit(session, semaphore, trade, after, retries):
+    '''
+    POST the knockdown of one trade and return ('submitted', transaction id),
+    ('failed', None) when the contract host rejects it or answers without a
+    transaction id the node could confirm it by, ('pending', None) when it was
+    not sent, or ('unknown', None) when it was sent but the answer was lost to
+    a timeout, a dropped connection or a 5xx. The host may have broadcast such
+    a knockdown, so only connection errors, raised before anything is sent,
+    are retried with exponential backoff; the others stay submitted for
+    requeue_stale_trades. A trade waits for the earlier trades of the batch
+    that share one of its orders, so each order is knocked down in trade
+    order: it goes back to pending, unsent, if one of them failed or was not
+    sent, and stays submitted with one whose outcome is unknown, so the stale
+    requeue releases them together and the next batch cannot send it first.
+    '''
+    for task in after:
+        state = (await task)[0]
+        if state == 'unknown':
+            return ('unknown', None)
+        if state != 'submitted':
+            return ('pending', None)
+    if trade['token_id'] == 1:
+        program_function = "knockdown"
+    else:
+        program_function = "knockdown_2"
+    data = dict(
+        program_id=contract_name,
+        program_function=program_function,
+        inputs=[f"{trade['buy_order_id']}u64", f"{trade['sell_order_id']}u64"],
+        private_key=private_key,
+        fee=1000,
+    )
+    async with semaphore:
+        for attempt in range(retries):
+            start = time.perf_counter()
+            try:
+                async with session.post(url=contract_url, json=data) as resp:
+                    metrics.KNOCKDOWN_SECONDS.observe(time.perf_counter() - start)
+                    if resp.ok:
+                        body = await resp.text()
+                        tx_id = transaction_id(body)
+                        if not tx_id:
+                            # sent, but never confirmable and not safe to send again: left for manual review
+                            print(f"no transaction id for the knockdown of trade {trade['id']}: {body!r}")
+                            return ('failed', None)
+                        db.record_transaction(trade['id'], tx_id)
+                        return ('submitted', tx_id)
+                    print("failed to call contract")
+                    print(contract_url)
+                    print(resp.status)
+                    print(await resp.text())
+                    if 400 <= resp.status < 500:
+                        return ('failed', None)
+                    return ('unknown', None)
+            except aiohttp.ClientConnectorError as e:
+                print("failed to connect to contract host:", repr(e))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print("failed to call contract:", repr(e))
+                return ('unknown', None)
+            await asyncio.sleep(min(2 ** attempt, 30))
+    return ('pending', None)
+
+
+async def settle(session, semaphore, trades, retries):
+    tasks = []
+    last = {} # order id -> task of the latest trade using it
+    for trade in trades:
+        after = {last[order_id] for order_id in (trade['buy_order_id'], trade['sell_order_id']) if order_id in last}
+        task = asyncio.create_task(submit(session, semaphore, trade, after, retries))
+        last[trade['buy_order_id']] = last[trade['sell_order_id']] = task
+        tasks.append(task)
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def run(bus=None):
     psqlurl = os.environ.get("PSQLURL")
+    global db, private_key, contract_name, contract_url
     private_key = os.environ.get('PRIVATE_KEY')
     contract_name = os.environ.get("CONTRACT_NAME", 'privx_xyz.aleo')
-    global db
+    contract_url = f"{os.environ.get('CONTRACT_HOST')}/testnet3/execute"
+    batch_size = int(os.environ.get("SETTLE_BATCH", 100))
+    semaphore = asyncio.Semaphore(int(os.environ.get("SETTLE_CONCURRENCY", 8)))
+    retries = int(os.environ.get("SETTLE_RETRIES", 5))
+    # unconfirmed knockdowns are sent again after SETTLE_TIMEOUT seconds, once the node synced SETTLE_BLOCKS blocks past them
+    timeout = datetime.timedelta(seconds=int(os.environ.get("SETTLE_TIMEOUT", 600)))
+    blocks = int(os.environ.get("SETTLE_BLOCKS", 100))
     db = Database(psqlurl)
+    queue = bus.subscribe(Message.Type.DatabaseTradesAdded) if bus else None
 
-    async with aiohttp.ClientSession() as session:
+    async with aiohttp.ClientSession(timeout=TIMEOUT) as session:
         while True:
-            await asyncio.sleep(2)
-            trade = db.get_offchain_trade_pair()
-            if not trade:
-                continue
-
-            print('call contract to onchain trades-----------------')
-            contract_url = f"{os.environ.get('CONTRACT_HOST')}/testnet3/execute"
-            if trade['token_id'] == 1:
-                program_function = "knockdown"
-            else:
-                program_function = "knockdown_2"
-            data = dict(
-                program_id=contract_name,
-                program_function=program_function,
-                inputs=[f"{trade['buy_order_id']}u64", f"{trade['sell_order_id']}u64"],
-                private_key=private_key,
-                fee=1000,
-            )
-            async with session.post(url=contract_url, json=data) as resp:
-                if not resp.ok:
-                    print("failed to call contract")
-                    print(contract_url)
-                    print(resp.status)
-                    print(await resp.text())
+            try:
+                requeued = db.requeue_stale_trades(timeout, blocks)
+                if requeued:
+                    print(f'{requeued} knockdowns not confirmed after {timeout} and {blocks} blocks, sending them again')
+                for state, count in db.count_unsettled_trades().items():
+                    metrics.SETTLEMENT_BACKLOG.set(count, state=state)
+                trades = db.get_pending_trades(batch_size)
+                if not trades:
+                    # woken by the dealer as soon as trades are committed, polling is only a fallback
+                    await next_message(queue, 2)
                     continue
 
-            db.onchain_trade(trade['id'])
+                print(f'call contract to onchain {len(trades)} trades-----------------')
+                # trades are marked submitted before anything is sent and confirmed by node.run from the blocks
+                db.submit_trades([trade['id'] for trade in trades])
+                results = await settle(session, semaphore, trades, retries)
+                failed = [trade['id'] for trade, (state, _) in zip(trades, results) if state == 'failed']
+                released = [trade['id'] for trade, (state, _) in zip(trades, results) if state == 'pending']
+                # only trades certainly not sent go back to pending; the ones with an unknown
+                # outcome stay submitted, without a transaction id to confirm them by
+                db.settle_trades(failed, released)
+                for result in ('submitted', 'failed', 'pending', 'unknown'):
+                    metrics.KNOCKDOWNS.inc(sum(state == result for state, _ in results), result=result)
+                if released:
+                    # the rest stays pending for the next batch
+                    await asyncio.sleep(2)
+            except Exception as e:
+                # Nothing restarts this task in the default mode, so any error only ends the
+                # round. Trades claimed by it stay submitted, whether or not their knockdown
+                # went out, and requeue_stale_trades sends them again if it never shows up.
+                print("failed to settle trades:", repr(e))
+                db.session.rollback()
+                await asyncio.sleep(2)
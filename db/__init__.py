@@ -1 +1 @@
-from .db import Database
+from .db import Database, AsyncDatabase, format_prices, CANDLE_RESOLUTIONS
@@ -1,13 +1,24 @@
+import asyncio
 import datetime
+import functools
+import json
+import math
+import numpy as np
 import pandas as pd
 import os
-from io import StringIO
-from sqlalchemy import func, or_
-from sqlalchemy import create_engine
-from sqlalchemy.sql import text
-from sqlalchemy.orm import sessionmaker
+import re
+import time
+from sqlalchemy import bindparam, case, exists, func, literal, null, or_, select, true, union, union_all
+from sqlalchemy import create_engine, insert, update, values, column
+from sqlalchemy import BigInteger, DateTime, Float, Integer, Interval, Numeric, String, cast
+from sqlalchemy.dialects.postgresql import aggregate_order_by, insert as pg_insert
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import aliased, sessionmaker
 
-from .models import Block, Order, Trade, Token
+from .models import Block, Candle, Knockdown, Order, Trade, Token
+from events import Message
+import metrics
 
 
 def u64(num):
@@ -15,10 +26,527 @@ def u64(num):
         return int(num[:-3])
 
 
+# contract function -> (token_id, side) of the order it places
+KNOCKDOWN_FUNCTIONS = ('knockdown', 'knockdown_2') # trade settlement, see contract.py
+ORDER_FUNCTIONS = {
+    'sell': (1, 'ask'),
+    'buy': (1, 'bid'),
+    'sell_2': (2, 'ask'),
+    'buy_2': (2, 'bid'),
+}
+
+
+# /api/history resolution -> bar length in seconds, the bars kept in the candle table
+CANDLE_RESOLUTIONS = {
+    '1Min': 60,
+    '5Min': 300,
+    '15Min': 900,
+    '30Min': 1800,
+    '60Min': 3600,
+    '1D': 86400,
+    '1W': 604800,
+}
+WEEK_START = 4 * 86400 # weekly bars start on Monday, 1970-01-01 was a Thursday
+WEEK_END = 3 * 86400 # pandas weekly bars end on Sunday
+
+
+def _bar_time(ts, seconds):
+    # label of the bar holding ts; weekly bars run Monday to Sunday and, like pandas '1W', are labelled with their Sunday
+    if seconds == CANDLE_RESOLUTIONS['1W']:
+        return ts - (ts - WEEK_START) % seconds + 6 * 86400
+    return ts - ts % seconds
+
+
+def _candle_rows(trades):
+    '''Fold trades (in time order) into one bar per token, resolution and bucket.'''
+    bars = {}
+    for trade in trades:
+        ts = int(trade['created_at'].timestamp())
+        price = trade['price']
+        for seconds in CANDLE_RESOLUTIONS.values():
+            key = (trade['token_id'], seconds, _bar_time(ts, seconds))
+            bar = bars.get(key)
+            if bar is None:
+                bars[key] = dict(token_id=key[0], resolution=seconds, time=key[2], open=price, high=price, low=price, close=price, volume=float(trade['quantity']))
+            else:
+                bar['high'] = max(bar['high'], price)
+                bar['low'] = min(bar['low'], price)
+                bar['close'] = price
+                bar['volume'] += float(trade['quantity'])
+    return list(bars.values())
+
+
+# Read queries are built and formatted by the helpers below, so Database (sync,
+# used by the workers) and AsyncDatabase (used by the api) share them.
+
+def _tokens_query():
+    return select(Token).order_by(Token.id)
+
+
+def _format_tokens(tokens):
+    functions = {order_function: function for function, order_function in ORDER_FUNCTIONS.items()}
+    ret = []
+    for i in tokens:
+        buy = functions.get((i.id, 'bid'))
+        sell = functions.get((i.id, 'ask'))
+        decimals = 6
+        ret.append(dict(id=i.id, base=i.base, quote=i.quote, symbol=i.symbol, contract_buy=buy, contract_sell=sell, decimals=decimals))
+    return ret
+
+
+def _valid_orders_query(filter=None, limit=None):
+    # plain columns joined with the token symbol, no ORM objects to hydrate
+    query = select(Order.id, Order.type, Order.side, Order.quantity, Order.origin_quantity, Order.price, Order.sum_price,
+                   Order.addr, Order.height, Order.created_at, Order.updated_at, Order.status, Order.token_id, Token.symbol)
+    query = query.join(Order.token).order_by(Order.id)
+    if filter:
+        filter = dict(filter)
+        if 'symbol' in filter:
+            symbol = filter.pop('symbol')
+            query = query.filter(Token.symbol == symbol)
+        if 'tm_from' in filter:
+            tm_from = filter.pop('tm_from')
+            query = query.filter(Order.created_at >= tm_from)
+        if 'tm_to' in filter:
+            tm_to = filter.pop('tm_to')
+            query = query.filter(Order.created_at <= tm_to)
+        if 'after_id' in filter:
+            after_id = filter.pop('after_id')
+            query = query.filter(Order.id > after_id)
+        query = query.filter(*[getattr(Order, key) == value for key, value in filter.items()])
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+def _format_orders(orders):
+    return [dict(trade_id=i.id, type=i.type, side=i.side, quantity=i.quantity, origin_quantity=i.origin_quantity,
+                price=i.price,
+                avg_price=0 if i.origin_quantity==i.quantity else i.sum_price/(i.origin_quantity-i.quantity),
+                addr=i.addr,
+                height=i.height, created_at=i.created_at, updated_at=i.updated_at,
+                status=i.status, symbol=i.symbol, token_id=i.token_id,
+                ) for i in orders]
+
+
+def _prices_queries(symbol=None):
+    query = select(func.sum(Order.quantity), Order.price).group_by(Order.price).order_by(Order.price.desc()).filter_by(status='todo')
+    if symbol is not None:
+        query = query.filter(Order.token.has(symbol=symbol))
+    return query.filter_by(side='ask'), query.filter_by(side='bid')
+
+
+def format_prices(ask_levels, bid_levels):
+    '''Depth ladder for /api/price from (quantity, price) levels, both sides sorted by price descending.'''
+    ret = []
+    sum_quantity = sum_price = 0
+    for quantity, price in reversed(ask_levels):
+        sum_quantity += quantity
+        sum_price += quantity * float(price)
+        ret.append(dict(side='ask', price=float(price), quantity=quantity, sum_price=sum_price, sum_quantity=sum_quantity))
+    ret.reverse()
+    sum_quantity = sum_price = 0
+    for quantity, price in bid_levels:
+        sum_quantity += quantity
+        sum_price += quantity * float(price)
+        ret.append(dict(side='bid', price=float(price), quantity=quantity, sum_price=sum_price, sum_quantity=sum_quantity))
+    return ret
+
+
+def _trades_query(symbol=None, tm_from=None, tm_to=None, onchain=None, addr=None, order_id=None, token_id=None, limit=None, after=None):
+    # one joined query projecting only the columns _format_trades reads
+    party1, party2 = aliased(Order), aliased(Order)
+    query = select(Trade.id, Trade.price, Trade.quantity, Trade.onchain, Trade.settlement, Trade.created_at, Trade.updated_at, Token.symbol,
+                   party1.id.label('party1_id'), party1.side.label('party1_side'), party1.price.label('party1_price'),
+                   party1.addr.label('party1_addr'), party1.quantity.label('party1_quantity'), party1.origin_quantity.label('party1_origin_quantity'),
+                   party2.id.label('party2_id'), party2.side.label('party2_side'), party2.price.label('party2_price'),
+                   party2.addr.label('party2_addr'), party2.quantity.label('party2_quantity'), party2.origin_quantity.label('party2_origin_quantity'))
+    query = query.join(party1, Trade.party1_order_id == party1.id).join(party2, Trade.party2_order_id == party2.id)
+    query = query.join(Token, Trade.token_id == Token.id).order_by(Trade.id)
+    if symbol is not None:
+        query = query.filter(Token.symbol == symbol)
+    if tm_from is not None:
+        query = query.filter(Trade.created_at >= tm_from)
+    if tm_to is not None:
+        query = query.filter(Trade.created_at <= tm_to)
+    if onchain is not None:
+        query = query.filter(Trade.onchain == onchain)
+    if addr is not None:
+        # a union of the two foreign key lookups uses ix_order_addr_id and ix_trade_party*_order_id, an OR over the joins cannot
+        owned = select(Order.id).where(Order.addr == addr)
+        query = query.filter(Trade.id.in_(union(select(Trade.id).where(Trade.party1_order_id.in_(owned)),
+                                                select(Trade.id).where(Trade.party2_order_id.in_(owned)))))
+    if order_id is not None:
+        query = query.filter(or_(Trade.party1_order_id == order_id, Trade.party2_order_id == order_id))
+    if token_id is not None:
+        query = query.filter(Trade.token_id == token_id)
+    if after is not None:
+        query = query.filter(Trade.id > after)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+def _format_trades(trades):
+    return [dict(id=i.id, price=i.price, quantity=i.quantity,
+                orders=[
+                    dict(trade_id=i.party1_id, type=i.party1_side, price=i.party1_price, addr=i.party1_addr),
+                    dict(trade_id=i.party2_id, type=i.party2_side, price=i.party2_price, addr=i.party2_addr),
+                ],
+                left=i.party1_quantity,
+                left_origin=i.party1_origin_quantity,
+                right=i.party2_quantity,
+                right_origin=i.party2_origin_quantity,
+                onchain=i.onchain,
+                settlement=i.settlement,
+                created_at=i.created_at,
+                updated_at=i.updated_at,
+                symbol=i.symbol,
+                ) for i in trades]
+
+
+def _summary_query(symbol=None):
+    now = datetime.datetime.now()
+    tm_from = now - datetime.timedelta(days=1)
+    query = select(Trade).filter(Trade.created_at >= tm_from)
+    if symbol:
+        query = query.filter(Trade.token.has(symbol=symbol))
+    return query
+
+
+def _format_summary(trades):
+    volume_24h = 0
+    high_24h = 0
+    low_24h = 0
+    quantity_24h = 0
+    for trade in trades:
+        volume_24h += trade.quantity * float(trade.price)
+        quantity_24h += trade.quantity
+        if high_24h == 0:
+            high_24h = trade.price
+        if low_24h == 0:
+            low_24h = trade.price
+        if trade.price < low_24h:
+            low_24h = trade.price
+        if trade.price > high_24h:
+            high_24h = trade.price
+    return dict(
+        volume_24h=volume_24h,
+        high_24h=high_24h,
+        low_24h=low_24h,
+        quantity_24h=quantity_24h,
+    )
+
+
+def _history_bins(resolution):
+    '''
+    (bar seconds, shift, origin) of a resolution binned in SQL, None for the
+    calendar ones left to pandas: the bar labelled t holds the trades from
+    t + shift to t + shift + seconds, labels count from origin (None when it
+    depends on the data). Fixed ones ('15Min', '2H', '3D') start at their
+    label, pandas weeks ('1W' is W-SUN) are labelled with their Sunday and
+    run from Monday through the whole Sunday.
+    '''
+    try:
+        offset = pd.tseries.frequencies.to_offset(resolution)
+    except ValueError:
+        return None
+    if isinstance(offset, pd.offsets.Week) and offset.n == 1 and offset.weekday == 6:
+        return 604800, -6 * 86400, WEEK_END
+    if not isinstance(offset, pd.offsets.Tick) or offset.nanos % 10**9:
+        return None
+    seconds = offset.nanos // 10**9
+    return seconds, 0, 0 if 86400 % seconds == 0 else None
+
+
+def _history_columns(symbol=None):
+    # epoch second, price and quantity of each trade, and the columns that order them
+    query = select(cast(func.floor(func.extract('epoch', Trade.created_at)), BigInteger).label('ts'), cast(Trade.price, Float).label('price'),
+                   Trade.quantity, Trade.created_at, Trade.id)
+    if symbol:
+        query = query.filter(Trade.token_id == select(Token.id).where(Token.symbol == symbol).scalar_subquery())
+    return query
+
+
+def _history_arrays(query):
+    # one row of three arrays in time order, much cheaper to fetch than a row per trade
+    trades = query.subquery()
+    return select(*[func.array_agg(aggregate_order_by(column, trades.c.created_at, trades.c.id)) for column in (trades.c.ts, trades.c.price, trades.c.quantity)])
+
+
+def _history_origin_query(symbol=None):
+    query = select(func.min(Trade.created_at))
+    if symbol:
+        query = query.filter(Trade.token_id == select(Token.id).where(Token.symbol == symbol).scalar_subquery())
+    return query
+
+
+def _history_origin(first_trade):
+    # pandas starts fixed bins that do not divide a day at midnight of the first trade's day
+    if first_trade is None:
+        return 0
+    ts = int(first_trade.timestamp())
+    return ts - ts % 86400
+
+
+@functools.lru_cache()
+def _history_query(symbol, tm_from, tm_to):
+    '''
+    The OHLCV bars labelled within [tm_from, tm_to], bucketed and gap filled
+    by Postgres, as one row of arrays (see _history_bins for the buckets).
+    Open and close are the first and last trade by (created_at, id).
+    Bars from the first to the last trade exist even without trades, carrying
+    the previous close with no volume as resample + pad did, and the window
+    is extended to tm_from / tm_to on the sides where trades lie beyond it.
+
+    Built once for each combination of the filters in use, see
+    _history_params for the values.
+    '''
+    step = bindparam('step', type_=Interval)
+    at = lambda name: bindparam(name, type_=DateTime(timezone=True))
+    label = func.date_bin(step, Trade.created_at, at('origin')) - bindparam('shift', type_=Interval)
+    trades = select(Trade)
+    if symbol:
+        trades = trades.where(Trade.token_id == select(Token.id).where(Token.symbol == bindparam('symbol')).scalar_subquery())
+    window = trades
+    if tm_from:
+        window = window.where(Trade.created_at >= at('lo'))
+        prev = trades.with_only_columns(cast(Trade.price, Float)).where(Trade.created_at < at('lo')) \
+            .order_by(Trade.created_at.desc(), Trade.id.desc()).limit(1).scalar_subquery()
+    if tm_to:
+        window = window.where(Trade.created_at < at('hi'))
+        later = exists(trades.where(Trade.created_at >= at('hi')))
+    window = window.with_only_columns(label.label('time'), cast(Trade.price, Float).label('price'), Trade.quantity, Trade.created_at, Trade.id).subquery()
+    # one sort finds the first and last trade of every bar, cheaper than ordered aggregates
+    order = dict(partition_by=window.c.time, order_by=(window.c.created_at, window.c.id))
+    ranked = select(window.c.time, window.c.price, window.c.quantity, func.lag(window.c.id).over(**order).is_(None).label('first'),
+                    func.lead(window.c.id).over(**order).is_(None).label('last')).subquery()
+    bars = select(ranked.c.time, func.max(ranked.c.price).filter(ranked.c.first).label('open'), func.max(ranked.c.price).label('high'),
+                  func.min(ranked.c.price).label('low'), func.max(ranked.c.price).filter(ranked.c.last).label('close'),
+                  func.sum(ranked.c.quantity).label('volume'), func.lead(ranked.c.time).over(order_by=ranked.c.time).label('next')) \
+        .group_by(ranked.c.time).cte('bars')
+    first, last, prev_close = func.min(bars.c.time), func.max(bars.c.time), cast(null(), Float)
+    if tm_from:
+        first, prev_close = case((prev.isnot(None), at('start')), else_=first), prev
+    if tm_to:
+        last = case((later, at('end')), else_=last)
+    bounds = select(first.label('first'), last.label('last'), func.min(bars.c.time).label('bar'), prev_close.label('prev')).cte('bounds')
+    # the empty bars ahead of the first trade in the window carry the close before it,
+    # each bar with trades is followed by the empty ones up to the next
+    gap = select(func.generate_series(bounds.c.first, func.coalesce(bounds.c.bar - step, bounds.c.last), step).label('time'),
+                 null().label('bar'), bounds.c.prev.label('open'), bounds.c.prev.label('high'), bounds.c.prev.label('low'),
+                 bounds.c.prev.label('close'), literal(0.0).label('volume'))
+    spread = select(func.generate_series(bars.c.time, func.coalesce(bars.c.next - step, bounds.c.last), step).label('time'),
+                    bars.c.time.label('bar'), bars.c.open, bars.c.high, bars.c.low, bars.c.close, bars.c.volume) \
+        .select_from(bars.join(bounds, true()))
+    slots = union_all(gap, spread).subquery()
+    filled = lambda column, empty: case((slots.c.time == slots.c.bar, column), else_=empty)
+    ohlcv = select(cast(func.extract('epoch', slots.c.time), BigInteger).label('t'), filled(slots.c.open, slots.c.close).label('o'),
+                   filled(slots.c.high, slots.c.close).label('h'), filled(slots.c.low, slots.c.close).label('l'), slots.c.close.label('c'),
+                   filled(slots.c.volume, 0).label('v')).subquery()
+    return select(*[func.array_agg(aggregate_order_by(column, ohlcv.c.t)) for column in ohlcv.c])
+
+
+def _history_params(symbol, tm_from, tm_to, seconds, shift, origin):
+    # a bar labelled t holds the trades from t + shift to t + shift + seconds
+    at = lambda ts: datetime.datetime.fromtimestamp(ts, datetime.timezone.utc)
+    params = dict(step=datetime.timedelta(seconds=seconds), shift=datetime.timedelta(seconds=shift), origin=at(origin + shift))
+    if symbol:
+        params.update(symbol=symbol)
+    if tm_from:
+        start = origin - (origin - math.floor(tm_from.timestamp())) // seconds * seconds
+        params.update(start=at(start), lo=at(start + shift))
+    if tm_to:
+        end = math.floor(tm_to.timestamp())
+        end -= (end - origin) % seconds
+        params.update(end=at(end), hi=at(end + seconds + shift))
+    return params
+
+
+def _format_history(columns):
+    # array_agg of no rows is NULL
+    if columns[0] is None:
+        return dict(
+            s='no_data'
+        )
+    return dict(s='ok', **{name: np.asarray(column, dtype='int64' if name == 't' else 'float64') for name, column in zip('tohlcv', columns)})
+
+
+def _history_trades_queries(symbol, tm_from, tm_to, seconds, shift, origin):
+    '''
+    HISTORY_BINS=numpy: the trades of the bars labelled within [tm_from, tm_to],
+    plus the last price before them and whether any trade follows them: those
+    decide whether the empty bars at either end of the window are reported.
+    '''
+    window = _history_columns(symbol)
+    before = after = start = end = None
+    if tm_from:
+        start = origin - (origin - math.floor(tm_from.timestamp())) // seconds * seconds
+        lo = datetime.datetime.fromtimestamp(start + shift, datetime.timezone.utc)
+        window = window.where(Trade.created_at >= lo)
+        before = _history_columns(symbol).where(Trade.created_at < lo).order_by(Trade.created_at.desc(), Trade.id.desc()).limit(1)
+    if tm_to:
+        end = math.floor(tm_to.timestamp())
+        end -= (end - origin) % seconds
+        hi = datetime.datetime.fromtimestamp(end + seconds + shift, datetime.timezone.utc)
+        window = window.where(Trade.created_at < hi)
+        after = _history_columns(symbol).where(Trade.created_at >= hi).limit(1)
+    return _history_arrays(window), before, after, start, end
+
+
+def _bin_history(columns, before, after, start, end, seconds, shift, origin):
+    '''
+    HISTORY_BINS=numpy: the bars of _history_query from the (epoch second, price,
+    quantity) arrays of _history_trades_queries, binned with integer arithmetic
+    and reduced per bar with numpy.
+    '''
+    # array_agg of no rows is NULL
+    rows = columns[0] is not None
+    if not rows and (before is None or after is None):
+        return dict(
+            s='no_data'
+        )
+    if rows:
+        ts, price, quantity = (np.asarray(column) for column in columns)
+        bars = ts - (ts - origin - shift) % seconds - shift
+        starts = np.flatnonzero(np.diff(bars, prepend=bars[0] - 1)) # first trade of each bar
+        ends = np.append(starts[1:], len(ts)) - 1
+        bars = bars[starts]
+        opens, highs, lows, closes = price[starts], np.maximum.reduceat(price, starts), np.minimum.reduceat(price, starts), price[ends]
+        volumes = np.add.reduceat(quantity, starts)
+    else:
+        bars = np.zeros(0, dtype='int64')
+        opens = highs = lows = closes = volumes = np.zeros(0)
+    if before is None:
+        start = bars[0]
+    if after is None:
+        end = bars[-1]
+    if start > end:
+        return dict(
+            s='no_data'
+        )
+    t = np.arange(start, end + 1, seconds, dtype='int64')
+    slots = (bars - start) // seconds
+    # the bar with trades at or before each slot, -1 (the close before the window) ahead of the first
+    latest = np.full(len(t), -1)
+    latest[slots] = np.arange(len(slots))
+    latest = np.maximum.accumulate(latest)
+    close = np.append(closes, np.nan if before is None else before.price)[latest]
+    o, h, l = close.copy(), close.copy(), close.copy()
+    o[slots] = opens
+    h[slots] = highs
+    l[slots] = lows
+    v = np.zeros(len(t), dtype='float64')
+    v[slots] = volumes
+    return dict(s='ok', t=t, o=o, h=h, l=l, c=close, v=v)
+
+
+def _resample_history(columns, tm_from=None, tm_to=None, resolution='15Min'):
+    # calendar resolutions, which bin by weekday or month, go through pandas
+    if columns[0] is None:
+        return dict(
+            s='no_data'
+        )
+    ts, price, quantity = (np.asarray(column) for column in columns)
+    data = pd.DataFrame(dict(LTP=price, LTQ=quantity), index=pd.to_datetime(ts, unit='s'))
+    resample_LTP = data['LTP'].resample(resolution).ohlc()
+    resample_LTQ = data['LTQ'].resample(resolution).sum()
+    # fill nan with prev closed price
+    closes = resample_LTP['close'].fillna(method='pad')
+    resample_LTP = resample_LTP.apply(lambda x: x.fillna(closes))
+    # slice time range
+    if tm_from:
+        resample_LTP = resample_LTP.loc[tm_from.strftime("%Y-%m-%d %H:%M:%S"):]
+        resample_LTQ = resample_LTQ.loc[tm_from.strftime("%Y-%m-%d %H:%M:%S"):]
+    if tm_to:
+        resample_LTP = resample_LTP.loc[:tm_to.strftime("%Y-%m-%d %H:%M:%S")]
+        resample_LTQ = resample_LTQ.loc[:tm_to.strftime("%Y-%m-%d %H:%M:%S")]
+
+    if resample_LTP.empty or resample_LTQ.empty:
+        return dict(
+            s='no_data'
+        )
+    # numpy columns, the api serializes them straight from the arrays
+    return dict(s='ok',
+                t=resample_LTP.index.values.astype('datetime64[s]').astype('int64'),
+                o=resample_LTP['open'].fillna(0).to_numpy(dtype='float64'),
+                h=resample_LTP['high'].fillna(0).to_numpy(dtype='float64'),
+                l=resample_LTP['low'].fillna(0).to_numpy(dtype='float64'),
+                c=resample_LTP['close'].fillna(0).to_numpy(dtype='float64'),
+                v=resample_LTQ.to_numpy(),
+                )
+
+
+def _candles_queries(symbol, tm_from, tm_to, seconds):
+    token_id = select(Token.id).where(Token.symbol == symbol).scalar_subquery()
+    query = select(Candle).where(Candle.token_id == token_id, Candle.resolution == seconds)
+    window = query.order_by(Candle.time)
+    before = after = None
+    if tm_from:
+        window = window.where(Candle.time >= int(tm_from.timestamp()))
+        before = query.where(Candle.time < int(tm_from.timestamp())).order_by(Candle.time.desc()).limit(1)
+    if tm_to:
+        window = window.where(Candle.time <= int(tm_to.timestamp()))
+        after = query.where(Candle.time > int(tm_to.timestamp())).order_by(Candle.time).limit(1)
+    return window, before, after
+
+
+def _format_candles(bars, before, after, tm_from, tm_to, seconds):
+    # Same shape as _format_history: buckets between the first and the last trade
+    # exist even without trades, carrying the previous close with no volume.
+    if not bars and (before is None or after is None):
+        return dict(
+            s='no_data'
+        )
+    if before is not None:
+        start = _bar_time(int(tm_from.timestamp()), seconds)
+        if start < int(tm_from.timestamp()):
+            start += seconds
+        close = before.close
+    else:
+        start = bars[0].time
+        close = None
+    if after is not None:
+        end = _bar_time(int(tm_to.timestamp()), seconds)
+        if end > int(tm_to.timestamp()):
+            end -= seconds
+    else:
+        end = bars[-1].time
+    if start > end:
+        # from and to within one bar
+        return dict(
+            s='no_data'
+        )
+    ret = dict(s='ok', t=[], o=[], h=[], l=[], c=[], v=[])
+    bars = {bar.time: bar for bar in bars}
+    for t in range(start, end + 1, seconds):
+        bar = bars.get(t)
+        if bar is not None:
+            close = bar.close
+            o, h, l, v = bar.open, bar.high, bar.low, bar.volume
+        else:
+            o = h = l = close
+            v = 0
+        ret['t'].append(t)
+        ret['o'].append(float(o))
+        ret['h'].append(float(h))
+        ret['l'].append(float(l))
+        ret['c'].append(float(close))
+        ret['v'].append(v)
+    return ret
+
+
 class Database:
-    def __init__(self, psqlurl):
+    def __init__(self, psqlurl, bus=None):
         self.engine = create_engine(psqlurl)
         self.session = sessionmaker(bind=self.engine)()
+        self.bus = bus
+        self.contract_name = os.environ.get("CONTRACT_NAME", 'privx_xyz.aleo')
+        self.history_bins = os.environ.get("HISTORY_BINS", 'sql')
+
+    def publish(self, type_, data):
+        if self.bus is not None:
+            self.bus.publish(Message(type_, data))
 
     def get_db_height(self):
         height = self.session.query(func.max(Block.height)).first()[0]
@@ -26,239 +554,335 @@ class Database:
             return -1
         return height
 
+    def get_last_ids(self):
+        # (last order id, last trade id), -1 when there are none, see recovery.MatchState
+        last_order, last_trade = self.session.execute(select(func.max(Order.id), select(func.max(Trade.id)).scalar_subquery())).one()
+        return (-1 if last_order is None else last_order), (-1 if last_trade is None else last_trade)
+
+    def get_last_trade_id(self, order_ids):
+        # the last trade of the incoming orders in order_ids, None if they were not matched
+        return self.session.scalar(select(func.max(Trade.id)).where(Trade.party2_order_id.in_(order_ids)))
+
     def load_token_ids(self):
         results = self.session.query(Token.id).distinct().order_by(Token.id)
         return [r for (r,) in results]
 
     def load_tokens(self):
-        query = self.session.query(Token).order_by(Token.id)
-        tokens = query.all()
-        ret = []
-        for i in tokens:
-            if i.id == 1:
-                buy = 'buy'
-                sell = 'sell'
-                decimals = 6
-            else:
-                buy = 'buy_2'
-                sell = 'sell_2'
-                decimals = 6
-            ret.append(dict(id=i.id, base=i.base, quote=i.quote, symbol=i.symbol, contract_buy=buy, contract_sell=sell, decimals=decimals))
-        return ret
-    def load_valid_orders(self, filter=None):
-        query = self.session.query(Order).order_by(Order.id)
-        if filter:
-            if 'symbol' in filter:
-                symbol = filter.pop('symbol')
-                query = query.filter(Order.token.has(symbol=symbol))
-            if 'tm_from' in filter:
-                tm_from = filter.pop('tm_from')
-                query = query.filter(Order.created_at >= tm_from)
-            if 'tm_to' in filter:
-                tm_to = filter.pop('tm_to')
-                query = query.filter(Order.created_at <= tm_to)
-            query = query.filter_by(**filter)
-        orders = query.all()
-        return [dict(trade_id=i.id, type=i.type, side=i.side, quantity=i.quantity, origin_quantity=i.origin_quantity,
-                    price=i.price,
-                    avg_price=0 if i.origin_quantity==i.quantity else i.sum_price/(i.origin_quantity-i.quantity),
-                    addr=i.addr,
-                    height=i.height, created_at=i.created_at, updated_at=i.updated_at,
-                    status=i.status, symbol=i.token.symbol,
-                    ) for i in orders]
+        return _format_tokens(self.session.scalars(_tokens_query()).all())
+
+    def load_valid_orders(self, filter=None, limit=None):
+        return _format_orders(self.session.execute(_valid_orders_query(filter, limit)).all())
 
     def load_prices(self, symbol=None):
-        query = self.session.query(func.sum(Order.quantity), Order.price).group_by(Order.price).order_by(Order.price.desc()).filter_by(status='todo')
-        if symbol is not None:
-            query = query.filter(Order.token.has(symbol=symbol))
-        ask_orders = query.filter_by(side='ask').all()
-        bid_orders = query.filter_by(side='bid').all()
-        ret = []
-        sum_quantity = sum_price = 0
-        for order in reversed(ask_orders):
-            sum_quantity += order[0]
-            sum_price += order[0] * float(order[1])
-            ret.insert(0, dict(side='ask', price=float(order[1]), quantity=order[0], sum_price=sum_price, sum_quantity=sum_quantity))
-        sum_quantity = sum_price = 0
-        for order in bid_orders:
-            sum_quantity += order[0]
-            sum_price += order[0] * float(order[1])
-            ret.append(dict(side='bid', price=float(order[1]), quantity=order[0], sum_price=sum_price, sum_quantity=sum_quantity))
-        return ret
-
-    def get_offchain_trade_pair(self):
-        trade = self.session.query(Trade).filter_by(onchain=False).first()
-        if trade:
-            if trade.party1_order.side == 'ask':
-                return dict(id=trade.id, sell_order_id=trade.party1_order.id, buy_order_id=trade.party2_order.id, token_id=trade.token_id)
+        ask_query, bid_query = _prices_queries(symbol)
+        return format_prices(self.session.execute(ask_query).all(), self.session.execute(bid_query).all())
+
+    def get_pending_trades(self, limit):
+        # oldest unsettled trades first, straight off ix_trade_pending_id
+        party1, party2 = aliased(Order), aliased(Order)
+        query = select(Trade.id, Trade.token_id, party1.id.label('party1_id'), party1.side.label('party1_side'), party2.id.label('party2_id'))
+        query = query.join(party1, Trade.party1_order_id == party1.id).join(party2, Trade.party2_order_id == party2.id)
+        query = query.filter(Trade.settlement == 'pending').order_by(Trade.id).limit(limit)
+        trades = []
+        for i in self.session.execute(query):
+            if i.party1_side == 'ask':
+                trades.append(dict(id=i.id, sell_order_id=i.party1_id, buy_order_id=i.party2_id, token_id=i.token_id))
             else:
-                return dict(id=trade.id, sell_order_id=trade.party2_order.id, buy_order_id=trade.party1_order.id, token_id=trade.token_id)
-        return trade
+                trades.append(dict(id=i.id, sell_order_id=i.party2_id, buy_order_id=i.party1_id, token_id=i.token_id))
+        return trades
+
+    def submit_trades(self, trade_ids):
+        # claimed before the knockdowns are sent, so a crash never leads to sending them twice
+        self.session.execute(update(Trade).where(Trade.id.in_(trade_ids), Trade.settlement == 'pending').values(
+            settlement='submitted', submitted_at=datetime.datetime.now(datetime.timezone.utc),
+            submitted_height=select(func.max(Block.height)).scalar_subquery(),
+        ).execution_options(synchronize_session=False))
+        self.session.commit()
+
+    def record_transaction(self, trade_id, transaction_id):
+        # written as soon as the knockdown is sent, before the node can see it in a block
+        self.session.execute(pg_insert(Knockdown).values(transaction_id=transaction_id, trade_id=trade_id).on_conflict_do_nothing())
+        self.session.execute(update(Trade).where(Trade.id == trade_id).values(
+            transaction_id=transaction_id,
+        ).execution_options(synchronize_session=False))
+        self.session.commit()
+
+    def settle_trades(self, failed, released):
+        # knockdowns the contract host rejected, and the ones certainly not sent, which go back to pending;
+        # a knockdown sent without an answer must stay submitted, a late one could confirm it.
+        # Trades the node confirmed meanwhile, by an earlier knockdown, stay confirmed
+        if failed:
+            self.session.execute(update(Trade).where(Trade.id.in_(failed), Trade.settlement == 'submitted').values(
+                settlement='failed',
+            ).execution_options(synchronize_session=False))
+        if released:
+            self.session.execute(update(Trade).where(Trade.id.in_(released), Trade.settlement == 'submitted').values(
+                settlement='pending', submitted_at=None, submitted_height=None,
+            ).execution_options(synchronize_session=False))
+        self.session.commit()
 
-    def onchain_trade(self, trade_id):
-        self.session.query(Trade).filter(Trade.id == trade_id).update({Trade.onchain:True})
+    def requeue_stale_trades(self, timeout, blocks):
+        # Knockdowns the node has not seen in a block after timeout, and after syncing blocks
+        # past the height they were claimed at, are sent again. Their transaction ids are
+        # kept, so one that lands late still confirms the trade.
+        cutoff = datetime.datetime.now(datetime.timezone.utc) - timeout
+        height = select(func.max(Block.height)).scalar_subquery()
+        result = self.session.execute(update(Trade).where(
+            Trade.settlement == 'submitted', Trade.submitted_at < cutoff, Trade.submitted_height <= height - blocks,
+        ).values(
+            settlement='pending', submitted_at=None, submitted_height=None,
+        ).execution_options(synchronize_session=False))
         self.session.commit()
+        return result.rowcount
 
-    def load_trades(self, symbol=None, tm_from=None, tm_to=None, onchain=None, addr=None, order_id=None, token_id=None):
-        query = self.session.query(Trade).order_by(Trade.id)
-        if symbol is not None:
-            query = query.filter(Trade.token.has(symbol=symbol))
-        if tm_from is not None:
-            query = query.filter(Trade.created_at >= tm_from)
-        if tm_to is not None:
-            query = query.filter(Trade.created_at <= tm_to)
-        if onchain is not None:
-            query = query.filter(Trade.onchain == onchain)
-        if addr is not None:
-            query = query.filter(or_(Trade.party1_order.has(addr=addr), Trade.party2_order.has(addr=addr)))
-        if order_id is not None:
-            query = query.filter(or_(Trade.party1_order.has(id=order_id), Trade.party2_order.has(id=order_id)))
-        if token_id is not None:
-            query = query.filter(Trade.token_id == token_id)
-        trades = query.all()
-        return [dict(id=i.id, price=i.price, quantity=i.quantity,
-                    orders=[
-                        dict(trade_id=i.party1_order.id, type=i.party1_order.side, price=i.party1_order.price, addr=i.party1_order.addr),
-                        dict(trade_id=i.party2_order.id, type=i.party2_order.side, price=i.party2_order.price, addr=i.party1_order.addr),
-                    ],
-                    left=i.party1_order.quantity,
-                    left_origin=i.party1_order.origin_quantity,
-                    right=i.party2_order.quantity,
-                    right_origin=i.party2_order.origin_quantity,
-                    onchain=i.onchain,
-                    created_at=i.created_at,
-                    updated_at=i.updated_at,
-                    symbol=i.token.symbol,
-                    ) for i in trades]
+    def count_unsettled_trades(self):
+        # pending and submitted trades, counted off their partial indexes: one count per
+        # state, an IN over both states cannot use either index
+        states = ('pending', 'submitted')
+        query = select(*[select(func.count()).select_from(Trade).where(Trade.settlement == state).scalar_subquery() for state in states])
+        return dict(zip(states, self.session.execute(query).one()))
+
+    def load_trades(self, symbol=None, tm_from=None, tm_to=None, onchain=None, addr=None, order_id=None, token_id=None, limit=None, after=None):
+        query = _trades_query(symbol=symbol, tm_from=tm_from, tm_to=tm_to, onchain=onchain, addr=addr, order_id=order_id, token_id=token_id, limit=limit, after=after)
+        return _format_trades(self.session.execute(query).all())
 
     def summary_trade(self, symbol=None):
-        now = datetime.datetime.now()
-        tm_from = now - datetime.timedelta(days=1)
-        query = self.session.query(Trade).filter(Trade.created_at >= tm_from)
-        if symbol:
-            query = query.filter(Trade.token.has(symbol=symbol))
-
-        volume_24h = 0
-        high_24h = 0
-        low_24h = 0
-        quantity_24h = 0
-        for trade in query.all():
-            volume_24h += trade.quantity * float(trade.price)
-            quantity_24h += trade.quantity
-            if high_24h == 0:
-                high_24h = trade.price
-            if low_24h == 0:
-                low_24h = trade.price
-            if trade.price < low_24h:
-                low_24h = trade.price
-            if trade.price > high_24h:
-                high_24h = trade.price
-        return dict(
-            volume_24h=volume_24h,
-            high_24h=high_24h,
-            low_24h=low_24h,
-            quantity_24h=quantity_24h,
-        )
+        return _format_summary(self.session.scalars(_summary_query(symbol)).all())
 
     def load_history(self, symbol=None, tm_from=None, tm_to=None, resolution='15Min'):
-        query = self.session.query(Trade)
-        if symbol:
-            query = query.filter(Trade.token.has(symbol=symbol))
-        # if tm_from:
-        #     query = query.filter(Trade.created_at >= tm_from)
-        # if tm_to:
-        #     query = query.filter(Trade.created_at <= tm_to)
-        trades = query.all()
-        if not trades:
-            return dict(
-                s='no_data'
-            )
-
-        data = ''
-        for trade in trades:
-            data += f'{trade.created_at.strftime("%Y-%m-%d %H:%M:%S")},{trade.price},{trade.quantity}\n'
-
-        data = pd.read_csv(StringIO(data), names=['Date_Time', 'LTP', 'LTQ'], index_col=0)
-        # Convert the index to datetime
-        data.index = pd.to_datetime(data.index, format='%Y-%m-%d %H:%M:%S')
-        resample_LTP = data['LTP'].resample(resolution).ohlc()
-        resample_LTQ = data['LTQ'].resample(resolution).sum()
-        # fill nan with prev closed price
-        closes = resample_LTP['close'].fillna(method='pad')
-        resample_LTP = resample_LTP.apply(lambda x: x.fillna(closes))
-        # slice time range
-        if tm_from:
-            resample_LTP = resample_LTP.loc[tm_from.strftime("%Y-%m-%d %H:%M:%S"):]
-            resample_LTQ = resample_LTQ.loc[tm_from.strftime("%Y-%m-%d %H:%M:%S"):]
-        if tm_to:
-            resample_LTP = resample_LTP.loc[:tm_to.strftime("%Y-%m-%d %H:%M:%S")]
-            resample_LTQ = resample_LTQ.loc[:tm_to.strftime("%Y-%m-%d %H:%M:%S")]
-
-        if resample_LTP.empty or resample_LTQ.empty:
-            return dict(
-                s='no_data'
-            )
-        return dict(s='ok',
-                    t=[int(i.astype('datetime64[s]').astype('int')) for i in resample_LTP.index.values],
-                    o=list(resample_LTP['open'].fillna(0).values),   # or .to_numpy()
-                    h=list(resample_LTP['high'].fillna(0).values),
-                    l=list(resample_LTP['low'].fillna(0).values),
-                    c=list(resample_LTP['close'].fillna(0).values),
-                    v=list(resample_LTQ.values),
-                    )
+        bins = _history_bins(resolution)
+        if bins is None:
+            return _resample_history(self.session.execute(_history_arrays(_history_columns(symbol))).one(), tm_from, tm_to, resolution)
+        seconds, shift, origin = bins
+        if origin is None:
+            origin = _history_origin(self.session.scalar(_history_origin_query(symbol)))
+        if self.history_bins == 'numpy':
+            window, before, after, start, end = _history_trades_queries(symbol, tm_from, tm_to, seconds, shift, origin)
+            return _bin_history(self.session.execute(window).one(),
+                                self.session.execute(before).first() if before is not None else None,
+                                self.session.execute(after).first() if after is not None else None,
+                                start, end, seconds, shift, origin)
+        query = _history_query(bool(symbol), bool(tm_from), bool(tm_to))
+        return _format_history(self.session.execute(query, _history_params(symbol, tm_from, tm_to, seconds, shift, origin)).one())
+
+    def load_candles(self, symbol=None, tm_from=None, tm_to=None, resolution='15Min'):
+        seconds = CANDLE_RESOLUTIONS.get(resolution)
+        if symbol is None or seconds is None:
+            return self.load_history(symbol=symbol, tm_from=tm_from, tm_to=tm_to, resolution=resolution)
+        window, before, after = _candles_queries(symbol, tm_from, tm_to, seconds)
+        return _format_candles(self.session.scalars(window).all(),
+                               self.session.scalars(before).first() if before is not None else None,
+                               self.session.scalars(after).first() if after is not None else None,
+                               tm_from, tm_to, seconds)
+
+    def _upsert_candles(self, trades):
+        # returns the bars as stored after the merge, for streaming
+        rows = _candle_rows(trades)
+        if not rows:
+            return []
+        stmt = pg_insert(Candle).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Candle.token_id, Candle.resolution, Candle.time],
+            set_=dict(
+                high=func.greatest(Candle.high, stmt.excluded.high),
+                low=func.least(Candle.low, stmt.excluded.low),
+                close=stmt.excluded.close,
+                volume=Candle.volume + stmt.excluded.volume,
+            ),
+        ).returning(Candle.token_id, Candle.resolution, Candle.time, Candle.open, Candle.high, Candle.low, Candle.close, Candle.volume)
+        return [row._asdict() for row in self.session.execute(stmt)]
+
+    def backfill_candles(self):
+        # build the candle table from the trade history, once, for databases that predate it
+        if self.session.query(Candle.time).first() is not None:
+            return
+        query = select(Trade.token_id, Trade.price, Trade.quantity, Trade.created_at).order_by(Trade.id)
+        trades = [row._asdict() for row in self.session.execute(query)]
+        rows = _candle_rows(trades)
+        for i in range(0, len(rows), 5000):
+            self.session.execute(insert(Candle), rows[i:i + 5000])
+        self.session.commit()
 
     def save_block(self, block):
+        return self.save_blocks([block])
+
+    def save_block_range(self, start, end, body):
+        # Most ranges carry nothing for our program: if its name never appears in the
+        # raw response, record the heights without decoding the JSON at all. A short
+        # or cut off response must not mark blocks it lacks as synced, so the body has
+        # to end with the last block of the range.
+        if self.contract_name.encode() not in body:
+            if not re.search(rb'"height":\s*%d\b' % (end - 1), body) or not body.rstrip().endswith(b']'):
+                raise ValueError(f"incomplete response for blocks {start} to {end - 1}")
+            with metrics.BLOCK_COMMIT_SECONDS.time():
+                self.session.execute(insert(Block), [dict(height=height) for height in range(start, end)])
+                self.session.commit()
+            metrics.BLOCKS_SAVED.inc(end - start)
+            self.publish(Message.Type.DatabaseBlockAdded, dict(height=end - 1, orders=[]))
+            return end - 1
+        with metrics.BLOCK_DECODE_SECONDS.time():
+            blocks = json.loads(body)
+        if [block['header']['metadata']['height'] for block in blocks] != list(range(start, end)):
+            raise ValueError(f"incomplete response for blocks {start} to {end - 1}")
+        return self.save_blocks(blocks)
+
+    def save_blocks(self, blocks):
+        # one transaction for the whole range, in block order
+        start = time.perf_counter()
+        orders = []
+        knockdowns = []
+        for block in blocks:
+            orders += self._add_block(block, knockdowns)
+        confirmed = []
+        if knockdowns:
+            # by any knockdown ever sent for the trade, also when it was sent again or failed since
+            sent = select(Knockdown.trade_id).where(Knockdown.transaction_id.in_(knockdowns))
+            confirmed = self.session.scalars(update(Trade).where(Trade.id.in_(sent), Trade.settlement != 'confirmed').values(
+                settlement='confirmed', onchain=True,
+            ).returning(Trade.created_at).execution_options(synchronize_session=False)).all()
+        self.session.add_all(orders)
+        self.session.flush()
+        # capture the matching-engine view before commit expires the instances
+        orders = [dict(trade_id=i.id, type=i.type, side=i.side, quantity=i.quantity, origin_quantity=i.origin_quantity,
+                       price=i.price, addr=i.addr, height=i.height, created_at=i.created_at, status=i.status,
+                       token_id=i.token_id) for i in orders]
+        self.session.commit()
+        metrics.BLOCK_COMMIT_SECONDS.observe(time.perf_counter() - start)
+        metrics.BLOCKS_SAVED.inc(len(blocks))
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for created_at in confirmed:
+            metrics.SETTLEMENT_SECONDS.observe((now - created_at).total_seconds())
+        height = blocks[-1]['header']['metadata']['height']
+        self.publish(Message.Type.DatabaseBlockAdded, dict(height=height, orders=orders))
+        return height
+
+    def _add_block(self, block, knockdowns):
+        # orders placed in the block are returned, ids of accepted knockdown transactions appended to knockdowns
         height = block['header']['metadata']['height']
-        created_at = datetime.datetime.fromtimestamp(block['header']['metadata']['timestamp'])
         self.session.add(Block(height=height))
-        contract_name = os.environ.get("CONTRACT_NAME", 'privx_xyz.aleo')
+        created_at = None
+        orders = []
         for transaction in block['transactions']:
             if transaction['status'] != 'accepted' or transaction['type'] != 'execute':
                 continue
             for transition in transaction['transaction']['execution']['transitions']:
-                if transition['program'] != contract_name:
+                if transition['program'] != self.contract_name:
+                    continue
+                if transition['function'] in KNOCKDOWN_FUNCTIONS:
+                    knockdowns.append(transaction['transaction']['id'])
                     continue
-                if transition['function'] == 'sell':
-                    print(height, 'sell')
-                    addr, quantity, price = transition['finalize']
-                    self.session.add(Order(token_id=1, side='ask', price=u64(price), quantity=u64(quantity), origin_quantity=u64(quantity), addr=addr, height=height, created_at=created_at))
-                elif transition['function'] == 'buy':
-                    print(height, 'buy')
-                    addr, quantity, price = transition['finalize']
-                    self.session.add(Order(token_id=1, side='bid', price=u64(price), quantity=u64(quantity), origin_quantity=u64(quantity), addr=addr, height=height, created_at=created_at))
-                elif transition['function'] == 'sell_2':
-                    print(height, 'sell')
-                    addr, quantity, price = transition['finalize']
-                    self.session.add(Order(token_id=2, side='ask', price=u64(price), quantity=u64(quantity), origin_quantity=u64(quantity), addr=addr, height=height, created_at=created_at))
-                elif transition['function'] == 'buy_2':
-                    print(height, 'buy')
-                    addr, quantity, price = transition['finalize']
-                    self.session.add(Order(token_id=2, side='bid', price=u64(price), quantity=u64(quantity), origin_quantity=u64(quantity), addr=addr, height=height, created_at=created_at))
+                order_function = ORDER_FUNCTIONS.get(transition['function'])
+                if order_function is None:
+                    continue
+                token_id, side = order_function
+                print(height, transition['function'])
+                if created_at is None:
+                    created_at = datetime.datetime.fromtimestamp(block['header']['metadata']['timestamp'])
+                addr, quantity, price = transition['finalize']
+                orders.append(Order(token_id=token_id, side=side, price=u64(price), quantity=u64(quantity), origin_quantity=u64(quantity), addr=addr, height=height, created_at=created_at))
+        return orders
+
+    def match_orders(self, books, orders):
+        # books (token_id -> OrderBook) is owned by the caller and outlives this call,
+        # so orders must only be fed in once.
+        from matcher import match
+        self.save_matches(*match(books, orders))
+
+    def save_matches(self, order_updates, new_trades):
+        # the single persistence stage for matching results, local or from the shards of matcher.py
+        if not new_trades:
+            return
+        start = time.perf_counter()
+        created_at = datetime.datetime.now(datetime.timezone.utc)
+        for trade in new_trades:
+            trade['created_at'] = created_at
+        # one multi-row UPDATE ... FROM (VALUES ...) and one batched INSERT per pass, in a single transaction
+        changes = values(column('id', Integer), column('quantity', Integer), column('status', String), column('amount', Numeric), name='changes')
+        changes = changes.data([(order_id, int(quantity), status, amount) for order_id, (quantity, status, amount) in order_updates.items()])
+        self.session.execute(update(Order).where(Order.id == changes.c.id).values(
+            quantity=changes.c.quantity, status=changes.c.status, sum_price=Order.sum_price + changes.c.amount,
+        ).execution_options(synchronize_session=False))
+        trade_ids = self.session.scalars(insert(Trade).returning(Trade.id, sort_by_parameter_order=True), new_trades).all()
+        candles = self._upsert_candles(new_trades)
         self.session.commit()
-        return height
+        metrics.MATCH_SAVE_SECONDS.observe(time.perf_counter() - start)
+        for trade, trade_id in zip(new_trades, trade_ids):
+            trade['id'] = trade_id
+        self.publish(Message.Type.DatabaseTradesAdded, dict(trades=new_trades, candles=candles))
 
-    def match_orders(self):
-        for token_id in self.load_token_ids():
-            orders = self.load_valid_orders({'status': 'todo', 'token_id': token_id})
-            from orderbook import OrderBook
-            match_engine = OrderBook()
-            for o in orders:
-                trades, order_left = match_engine.process_order(o, False, False)
-                if len(trades) == 0:
-                    continue
 
-                if order_left is None:
-                    self.session.query(Order).filter(Order.id == o['trade_id']).update({Order.status:'done', Order.quantity:0})
-                else:
-                    self.session.query(Order).filter(Order.id == o['trade_id']).update({Order.quantity: order_left['quantity']})
+class AsyncDatabase:
+    '''
+    Read-only database access for the api on an asyncpg connection pool. Every
+    call checks out its own session, so concurrent requests run in parallel up
+    to the pool size instead of blocking the event loop.
+    '''
+    def __init__(self, psqlurl, pool_size=None):
+        url = make_url(psqlurl).set(drivername='postgresql+asyncpg')
+        pool_size = pool_size or int(os.environ.get("PSQL_POOL_SIZE", 10))
+        self.engine = create_async_engine(url, pool_size=pool_size, max_overflow=0, pool_pre_ping=True)
+        self.sessionmaker = async_sessionmaker(self.engine, expire_on_commit=False)
+        self.history_bins = os.environ.get("HISTORY_BINS", 'sql')
 
-                for t in trades:
-                    if t['party1'][3] is None:
-                        self.session.query(Order).filter(Order.id == t['party1'][0]).update({Order.status:'done', Order.quantity:0})
-                    else:
-                        self.session.query(Order).filter(Order.id == t['party1'][0]).update({Order.quantity:t['party1'][3]})
+    async def close(self):
+        await self.engine.dispose()
 
-                    self.session.execute(text(f'update "order" set sum_price=sum_price+{t["quantity"]*t["price"]} where id={t["party1"][0]} or id={t["party2"][0]}'))
-                    self.session.add(Trade(token_id=token_id, price=t['price'], quantity=t['quantity'], party1_order_id=t['party1'][0], party2_order_id=t['party2'][0]))
+    async def scalars(self, query):
+        async with self.sessionmaker() as session:
+            return (await session.scalars(query)).all()
 
-                self.session.commit()
+    async def rows(self, *queries):
+        async with self.sessionmaker() as session:
+            return [(await session.execute(query)).all() for query in queries]
+
+    async def load_tokens(self):
+        return _format_tokens(await self.scalars(_tokens_query()))
+
+    async def load_valid_orders(self, filter=None, limit=None):
+        return _format_orders((await self.rows(_valid_orders_query(filter, limit)))[0])
+
+    async def load_prices(self, symbol=None):
+        return format_prices(*await self.rows(*_prices_queries(symbol)))
+
+    async def load_trades(self, symbol=None, tm_from=None, tm_to=None, onchain=None, addr=None, order_id=None, token_id=None, limit=None, after=None):
+        query = _trades_query(symbol=symbol, tm_from=tm_from, tm_to=tm_to, onchain=onchain, addr=addr, order_id=order_id, token_id=token_id, limit=limit, after=after)
+        return _format_trades((await self.rows(query))[0])
+
+    async def summary_trade(self, symbol=None):
+        return _format_summary(await self.scalars(_summary_query(symbol)))
+
+    async def load_recent_trades(self, since):
+        # the columns the ticker needs, oldest first
+        query = select(Trade.id, Trade.token_id, Trade.price, Trade.quantity, Trade.created_at).filter(Trade.created_at >= since).order_by(Trade.id)
+        return [row._asdict() for row in (await self.rows(query))[0]]
+
+    async def load_history(self, symbol=None, tm_from=None, tm_to=None, resolution='15Min'):
+        bins = _history_bins(resolution)
+        if bins is None:
+            (columns,), = await self.rows(_history_arrays(_history_columns(symbol)))
+            # resampling is CPU bound, keep it off the event loop
+            return await asyncio.to_thread(_resample_history, columns, tm_from, tm_to, resolution)
+        seconds, shift, origin = bins
+        async with self.sessionmaker() as session:
+            if origin is None:
+                origin = _history_origin(await session.scalar(_history_origin_query(symbol)))
+            if self.history_bins != 'numpy':
+                query = _history_query(bool(symbol), bool(tm_from), bool(tm_to))
+                return _format_history((await session.execute(query, _history_params(symbol, tm_from, tm_to, seconds, shift, origin))).one())
+            window, before, after, start, end = _history_trades_queries(symbol, tm_from, tm_to, seconds, shift, origin)
+            columns = (await session.execute(window)).one()
+            before = (await session.execute(before)).first() if before is not None else None
+            after = (await session.execute(after)).first() if after is not None else None
+        # binning is CPU bound, keep it off the event loop
+        return await asyncio.to_thread(_bin_history, columns, before, after, start, end, seconds, shift, origin)
+
+    async def load_candles(self, symbol=None, tm_from=None, tm_to=None, resolution='15Min'):
+        seconds = CANDLE_RESOLUTIONS.get(resolution)
+        if symbol is None or seconds is None:
+            return await self.load_history(symbol=symbol, tm_from=tm_from, tm_to=tm_to, resolution=resolution)
+        window, before, after = _candles_queries(symbol, tm_from, tm_to, seconds)
+        async with self.sessionmaker() as session:
+            bars = (await session.scalars(window)).all()
+            before = (await session.scalars(before)).first() if before is not None else None
+            after = (await session.scalars(after)).first() if after is not None else None
+        return _format_candles(bars, before, after, tm_from, tm_to, seconds)
@@ -47,6 +47,11 @@ class Block(Base):
 
 class Order(Base):
     __tablename__ = 'order'
+    __table_args__ = (
+        # resting orders per book: the dealer's reload and /api/price
+        sqlalchemy.Index('ix_order_todo_book', 'token_id', 'side', 'price', postgresql_where=sqlalchemy.text("status = 'todo'")),
+        sqlalchemy.Index('ix_order_addr_id', 'addr', 'id'),
+    )
 
     id = sqlalchemy.Column(sqlalchemy.INTEGER, Sequence('order_id_seq', minvalue=0, start=0, increment=1), primary_key=True, autoincrement=True) # start from 0
     type = sqlalchemy.Column(ChoiceType({"limit": "limit", "market": "market"}), nullable=False, default='limit')
@@ -66,6 +71,14 @@ class Order(Base):
 
 class Trade(Base):
     __tablename__ = 'trade'
+    __table_args__ = (
+        # settlement queue, and the in-flight knockdowns the node confirms by transaction id
+        sqlalchemy.Index('ix_trade_pending_id', 'id', postgresql_where=sqlalchemy.text("settlement = 'pending'")),
+        sqlalchemy.Index('ix_trade_submitted_at', 'submitted_at', postgresql_where=sqlalchemy.text("settlement = 'submitted'")),
+        sqlalchemy.Index('ix_trade_token_created_at', 'token_id', 'created_at'),
+        sqlalchemy.Index('ix_trade_party1_order_id', 'party1_order_id'),
+        sqlalchemy.Index('ix_trade_party2_order_id', 'party2_order_id'),
+    )
 
     id = sqlalchemy.Column(sqlalchemy.INTEGER, primary_key=True)
     price = sqlalchemy.Column(sqlalchemy.DECIMAL)
@@ -78,4 +91,32 @@ class Trade(Base):
     token = relationship('Token', foreign_keys=[token_id], backref='trades')
     created_at = sqlalchemy.Column(sqlalchemy.DateTime(timezone=True), default=datetime.utcnow)
     updated_at = sqlalchemy.Column(sqlalchemy.DateTime(timezone=True), default=datetime.utcnow, onupdate=datetime.utcnow)
-    onchain = sqlalchemy.Column(sqlalchemy.Boolean, default=False)
+    onchain = sqlalchemy.Column(sqlalchemy.Boolean, default=False) # set once confirmed
+    # pending -> submitted (knockdown sent, its transaction id recorded) -> confirmed (any knockdown of the trade seen in a block)
+    # | failed (rejected by the contract host, or sent without an id to confirm it by: left for manual review)
+    settlement = sqlalchemy.Column(ChoiceType({"pending": "pending", "submitted": "submitted", "confirmed": "confirmed", "failed": "failed"}), nullable=False, default='pending')
+    transaction_id = sqlalchemy.Column(sqlalchemy.String(100)) # the latest knockdown, all of them are in the knockdown table
+    submitted_at = sqlalchemy.Column(sqlalchemy.DateTime(timezone=True))
+    submitted_height = sqlalchemy.Column(sqlalchemy.INTEGER) # local chain height when it was claimed
+
+
+class Knockdown(Base):
+    # every knockdown transaction sent for a trade, so a late one still confirms it after it was sent again
+    __tablename__ = 'knockdown'
+
+    transaction_id = sqlalchemy.Column(sqlalchemy.String(100), primary_key=True)
+    trade_id = sqlalchemy.Column(sqlalchemy.INTEGER, sqlalchemy.ForeignKey("trade.id"), nullable=False)
+    created_at = sqlalchemy.Column(sqlalchemy.DateTime(timezone=True), default=datetime.utcnow)
+
+
+class Candle(Base):
+    __tablename__ = 'candle'
+
+    token_id = sqlalchemy.Column(sqlalchemy.INTEGER, sqlalchemy.ForeignKey("token.id"), primary_key=True)
+    resolution = sqlalchemy.Column(sqlalchemy.INTEGER, primary_key=True) # bar length in seconds
+    time = sqlalchemy.Column(sqlalchemy.BIGINT, primary_key=True) # bar label, unix seconds: its start, the Sunday of a weekly bar
+    open = sqlalchemy.Column(sqlalchemy.DECIMAL)
+    high = sqlalchemy.Column(sqlalchemy.DECIMAL)
+    low = sqlalchemy.Column(sqlalchemy.DECIMAL)
+    close = sqlalchemy.Column(sqlalchemy.DECIMAL)
+    volume = sqlalchemy.Column(sqlalchemy.FLOAT, default=0)
@@ -1,14 +1,71 @@
 import os
-import asyncio
+import time
+import metrics
 from db import Database
+from events import Message, next_message
+from matcher import LocalMatcher, ShardedMatcher
+from recovery import MatchState
 
 
+def publish_depth(bus, depths):
+    '''Send the L2 depth of each book, versioned by the id of the last order fed into it.'''
+    if bus is None:
+        return
+    for token_id, depth in depths.items():
+        bus.publish(Message(Message.Type.DealerDepthUpdated, dict(token_id=token_id, version=versions[token_id], asks=depth['asks'], bids=depth['bids'])))
 
-async def run():
+
+async def run(bus=None):
     psqlurl = os.environ.get("PSQLURL")
-    global db
-    db = Database(psqlurl)
+    global db, versions
+    db = Database(psqlurl, bus)
+    db.backfill_candles()
+    # MATCH_SHARDS worker processes own the books, 0 keeps them in this process
+    shards = int(os.environ.get("MATCH_SHARDS", 0))
+    matcher = ShardedMatcher(shards) if shards > 0 else LocalMatcher()
+    # subscribe before the first load so no block committed in between is missed
+    queue = bus.subscribe(Message.Type.DatabaseBlockAdded) if bus else None
+    # The books are kept across passes. The first pass replays every todo order
+    # to build them, later passes only feed orders committed since then. With
+    # MATCH_STATE_DIR the books are restored from the snapshot and journal there
+    # instead, and the first pass only feeds the orders they do not have.
+    versions = {}
+    last_order_id = -1
+    state_dir = os.environ.get("MATCH_STATE_DIR")
+    state = MatchState(state_dir, float(os.environ.get("MATCH_SNAPSHOT_INTERVAL", 300))) if state_dir else None
+    if state:
+        last_order_id, versions = await state.restore(matcher, db)
+        publish_depth(bus, await matcher.depth())
     while True:
         print('match orders-----------------')
-        db.match_orders()
-        await asyncio.sleep(10)
+        orders = db.load_valid_orders({'status': 'todo', 'after_id': last_order_id})
+        while True:
+            if state:
+                state.append(orders)
+            start = time.perf_counter()
+            order_updates, trades, depths = await matcher.match(orders)
+            metrics.MATCH_SECONDS.observe(time.perf_counter() - start)
+            db.save_matches(order_updates, trades)
+            if state:
+                state.commit(orders, trades)
+            metrics.MATCH_PASS_ORDERS.observe(len(orders))
+            metrics.MATCH_PASS_TRADES.observe(len(trades))
+            metrics.ORDERS_MATCHED.inc(len(orders))
+            metrics.TRADES.inc(len(trades))
+            for token_id, depth in depths.items():
+                for side, count in depth['orders'].items():
+                    metrics.OPEN_ORDERS.set(count, token_id=token_id, side=side)
+            for o in orders:
+                versions[o['token_id']] = o['trade_id']
+            if orders:
+                last_order_id = orders[-1]['trade_id']
+            publish_depth(bus, depths)
+            if state:
+                await state.checkpoint(matcher, last_order_id, versions)
+            # new blocks are matched as soon as node commits them, polling is only a fallback
+            msg = await next_message(queue, 10)
+            if msg is None:
+                # idle: resend every book so late subscribers catch up
+                publish_depth(bus, await matcher.depth())
+                break
+            orders = [o for o in msg.data['orders'] if o['trade_id'] > last_order_id]
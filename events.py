@@ -0,0 +1,102 @@
+import asyncio
+import threading
+from collections import defaultdict
+from enum import IntEnum
+
+
+class Message:
+    class Type(IntEnum):
+        NodeConnectError = 0
+        NodeConnected = 1
+        NodeDisconnected = 2
+
+        DatabaseConnectError = 100
+        DatabaseConnected = 101
+        DatabaseDisconnected = 102
+        DatabaseError = 103
+        DatabaseBlockAdded = 104
+        DatabaseTradesAdded = 105
+
+        DealerDepthUpdated = 200
+
+        MetricsUpdated = 300
+
+    def __init__(self, type_: Type, data: any):
+        self.type = type_
+        self.data = data
+
+
+class EventBus:
+    '''
+    In-process publish/subscribe between the explorer roles. Each subscriber
+    gets its own asyncio.Queue, so a slow consumer never drops messages for
+    the others. Database polling stays in place as a fallback.
+
+    publish may be called from worker threads (e.g. a database write running
+    in asyncio.to_thread): messages are handed to each subscriber's loop.
+    '''
+
+    def __init__(self):
+        self.subscribers = defaultdict(list) # Message.Type -> [(loop, asyncio.Queue)]
+
+    def subscribe(self, *types, queue=None):
+        if queue is None:
+            queue = asyncio.Queue()
+        loop = asyncio.get_event_loop()
+        for type_ in types:
+            self.subscribers[type_].append((loop, queue))
+        return queue
+
+    def publish(self, msg: Message):
+        try:
+            current = asyncio.get_running_loop()
+        except RuntimeError:
+            current = None
+        for loop, queue in self.subscribers[msg.type]:
+            if loop is current:
+                queue.put_nowait(msg)
+            else:
+                loop.call_soon_threadsafe(queue.put_nowait, msg)
+
+
+class BridgedBus(EventBus):
+    '''
+    EventBus of one role process when the explorer runs a process per role.
+    Local publishes also go to the router in the parent process through
+    outbox, together with the types this process subscribes to, and the
+    messages routed from other processes arrive on inbox and are published
+    locally. Both are multiprocessing queues, so message data is pickled.
+    '''
+
+    def __init__(self, name, inbox, outbox):
+        super().__init__()
+        self.name = name
+        self.inbox = inbox
+        self.outbox = outbox
+        threading.Thread(target=self.receive, name=f'{name}-bus', daemon=True).start()
+
+    def subscribe(self, *types, queue=None):
+        self.outbox.put((self.name, 'subscribe', types))
+        return super().subscribe(*types, queue=queue)
+
+    def publish(self, msg: Message):
+        super().publish(msg)
+        self.outbox.put((self.name, 'publish', msg))
+
+    def receive(self):
+        while True:
+            super().publish(self.inbox.get())
+
+
+async def next_message(queue, timeout):
+    '''Wait for the next message on queue, or return None after timeout seconds.'''
+    if queue is None:
+        await asyncio.sleep(timeout)
+        return None
+    getter = asyncio.ensure_future(queue.get())
+    try:
+        done, _ = await asyncio.wait([getter], timeout=timeout)
+    finally:
+        if not getter.done():
+            getter.cancel()
+    return getter.result() if done else None
@@ -1,28 +1,48 @@
 import asyncio
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import threading
 import traceback
 
 import api
 import dealer
 import node
 import contract
-from enum import IntEnum
+import metrics
+from events import BridgedBus, EventBus, Message
 
 
-class Message:
-    class Type(IntEnum):
-        NodeConnectError = 0
-        NodeConnected = 1
-        NodeDisconnected = 2
+ROLES = {
+    'node': node.run,         # sync block to get order data
+    'dealer': dealer.run,     # order match as trade
+    'contract': contract.run, # upload trade to chain
+    'api': api.serve,         # provide rest api, one process per API_WORKERS
+}
 
-        DatabaseConnectError = 100
-        DatabaseConnected = 101
-        DatabaseDisconnected = 102
-        DatabaseError = 103
-        DatabaseBlockAdded = 104
 
-    def __init__(self, type_: Type, data: any):
-        self.type = type_
-        self.data = data
+def exit_with_parent():
+    multiprocessing.connection.wait([multiprocessing.parent_process().sentinel])
+    os._exit(1)
+
+
+def run_role(name, role, inbox, outbox):
+    # entry point of a role process started by Explorer.process_loop
+    from dotenv import load_dotenv
+    load_dotenv()
+    # no orphans when the launcher is killed without cleaning up
+    threading.Thread(target=exit_with_parent, daemon=True).start()
+    asyncio.run(run_with_metrics(ROLES[role], BridgedBus(name, inbox, outbox)))
+
+
+async def run_with_metrics(role, bus):
+    # the api processes serve /metrics for every role process from these snapshots
+    task = asyncio.create_task(metrics.publish(bus))
+    try:
+        await role(bus)
+    finally:
+        task.cancel()
 
 
 class Explorer:
@@ -30,22 +50,72 @@ class Explorer:
     def __init__(self):
         self.task = None
         self.message_queue = asyncio.Queue()
+        self.bus = EventBus()
         self.node = None
         self.dev_mode = False
         self.latest_height = 0
 
     def start(self):
-        self.task = asyncio.create_task(self.main_loop())
+        # EXPLORER_MODE=processes runs every role in its own process instead of as tasks on this loop
+        if os.environ.get("EXPLORER_MODE") == 'processes':
+            self.task = asyncio.create_task(self.process_loop())
+        else:
+            self.task = asyncio.create_task(self.main_loop())
 
     async def message(self, msg: Message):
         await self.message_queue.put(msg)
 
+    async def process_loop(self):
+        '''
+        Start node, dealer, contract and API_WORKERS api processes, then route
+        the bus messages between them: every message published in one process
+        is forwarded to the other processes subscribed to its type.
+        '''
+        context = multiprocessing.get_context('spawn')
+        outbox = context.Queue()
+        roles = [('node', 'node'), ('dealer', 'dealer'), ('contract', 'contract')]
+        roles += [(f'api-{i}', 'api') for i in range(int(os.environ.get("API_WORKERS", 1)))]
+        inboxes = {}
+        processes = {}
+        subscriptions = {} # process name -> message types
+        for name, role in roles:
+            inboxes[name] = context.Queue()
+            # not daemonic, the dealer may start MATCH_SHARDS processes of its own;
+            # the finally below and exit_with_parent take care of stopping them
+            processes[name] = context.Process(target=run_role, args=(name, role, inboxes[name], outbox), name=name)
+            processes[name].start()
+        try:
+            while True:
+                try:
+                    sender, kind, data = await asyncio.to_thread(outbox.get, timeout=1)
+                except queue.Empty:
+                    dead = [name for name, process in processes.items() if not process.is_alive()]
+                    if dead:
+                        raise RuntimeError(f"role process exited: {', '.join(dead)}")
+                    continue
+                if kind == 'subscribe':
+                    subscriptions.setdefault(sender, set()).update(data)
+                    continue
+                for name, types in subscriptions.items():
+                    if name != sender and data.type in types:
+                        inboxes[name].put(data)
+                if data.type == Message.Type.DatabaseBlockAdded:
+                    self.latest_height = data.data['height']
+        except Exception as e:
+            print("explorer error:", e)
+            traceback.print_exc()
+            raise
+        finally:
+            for process in processes.values():
+                process.terminate()
+
     async def main_loop(self):
         try:
-            asyncio.create_task(node.run())       # sync block to get order data
-            asyncio.create_task(api.run())        # provide rest api
-            asyncio.create_task(dealer.run())     # order match as trade
-            asyncio.create_task(contract.run())   # upload trade to chain
+            self.bus.subscribe(Message.Type.DatabaseBlockAdded, queue=self.message_queue)
+            asyncio.create_task(node.run(self.bus))       # sync block to get order data
+            asyncio.create_task(api.run(self.bus))        # provide rest api
+            asyncio.create_task(dealer.run(self.bus))     # order match as trade
+            asyncio.create_task(contract.run(self.bus))   # upload trade to chain
             while True:
                 msg = await self.message_queue.get()
                 if msg.type == Message.Type.NodeConnectError:
@@ -63,8 +133,7 @@ class Explorer:
                 elif msg.type == Message.Type.DatabaseError:
                     print("database error:", msg.data)
                 elif msg.type == Message.Type.DatabaseBlockAdded:
-                    # maybe do something later?
-                    pass
+                    self.latest_height = msg.data['height']
                 else:
                     raise ValueError("unhandled explorer message type")
         except Exception as e:
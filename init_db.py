@@ -1,4 +1,6 @@
 import os
+from alembic import command
+from alembic.config import Config
 from sqlalchemy import create_engine, func
 from sqlalchemy.orm import sessionmaker
 
@@ -22,3 +24,5 @@ if __name__ == '__main__':
         session.add(Block(height=start_height))
 
     session.commit()
+    # the tables match the latest migration, later schema changes go through alembic
+    command.stamp(Config(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'alembic.ini')), 'head')
@@ -0,0 +1,155 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from orderbook import OrderBook
+from recovery import dump_book, load_books
+
+
+def match(books, orders):
+    '''
+    Feed orders into their books (token_id -> OrderBook, created on first sight)
+    and return (order_updates, trades) for Database.save_matches. The books
+    outlive the call, so orders must only be fed in once.
+    '''
+    order_updates = {} # order id -> [quantity, status, sum_price increment], last write wins
+    new_trades = []
+
+    def update_order(order_id, quantity, amount):
+        change = order_updates.setdefault(order_id, [None, None, 0])
+        change[0] = quantity
+        change[1] = 'done' if quantity == 0 else 'todo'
+        change[2] += amount
+
+    for o in orders:
+        token_id = o['token_id']
+        match_engine = books.get(token_id)
+        if match_engine is None:
+            # on-chain prices and quantities are u64 already, so they are the ticks and lots
+            match_engine = books[token_id] = OrderBook(tick_size=1, integer=True)
+        trades, order_left = match_engine.process_order(o, False, False)
+        if len(trades) == 0:
+            continue
+
+        update_order(o['trade_id'], 0 if order_left is None else order_left['quantity'], 0)
+        for t in trades:
+            amount = t['quantity'] * t['price']
+            update_order(t['party1'][0], 0 if t['party1'][3] is None else t['party1'][3], amount)
+            update_order(t['party2'][0], order_updates[t['party2'][0]][0], amount)
+            new_trades.append(dict(token_id=token_id, price=t['price'], quantity=t['quantity'], party1_order_id=t['party1'][0], party2_order_id=t['party2'][0]))
+    return order_updates, new_trades
+
+
+def depth(book):
+    # (quantity, price) levels, highest price first, as load_prices returns them
+    return dict(
+        asks=[(volume, price) for price, volume in reversed(book.get_depth('ask'))],
+        bids=[(volume, price) for price, volume in book.get_depth('bid')],
+        orders=dict(ask=book.asks.num_orders, bid=book.bids.num_orders),
+    )
+
+
+class LocalMatcher:
+    '''All books in this process, matched one order after another.'''
+    def __init__(self):
+        self.books = {}
+
+    async def match(self, orders):
+        order_updates, trades = match(self.books, orders)
+        return order_updates, trades, {token_id: depth(self.books[token_id]) for token_id in {o['token_id'] for o in orders}}
+
+    async def depth(self):
+        return {token_id: depth(book) for token_id, book in self.books.items()}
+
+    async def dump(self):
+        return {token_id: dump_book(book) for token_id, book in self.books.items()}
+
+    async def restore(self, path, token_ids):
+        self.books = load_books(path, token_ids)
+
+
+# the books of the tokens assigned to this worker process
+books = {}
+
+
+def _match_shard(orders):
+    order_updates, trades = match(books, orders)
+    return order_updates, trades, {token_id: depth(books[token_id]) for token_id in {o['token_id'] for o in orders}}
+
+
+def _shard_depth():
+    return {token_id: depth(book) for token_id, book in books.items()}
+
+
+def _dump_shard():
+    return {token_id: dump_book(book) for token_id, book in books.items()}
+
+
+def _restore_shard(path, token_ids):
+    global books
+    books = load_books(path, token_ids)
+
+
+class ShardedMatcher:
+    '''
+    Books spread over worker processes, one single-worker pool per shard so a
+    token always lands on the process that owns its book. Tokens are assigned
+    round-robin the first time they are seen. A pass sends each shard only its
+    own orders and the shards match concurrently; books of different tokens
+    never interact, so merging the results gives the same updates as matching
+    everything in one process. Trades are put back in the order a single loop
+    would have produced them, by the incoming order id, and the caller persists
+    them in one transaction.
+    '''
+    def __init__(self, shards):
+        # spawn, so workers never inherit the parent's database connections
+        context = multiprocessing.get_context('spawn')
+        self.pools = [ProcessPoolExecutor(max_workers=1, mp_context=context) for _ in range(shards)]
+        self.shard_of = {} # token_id -> index into pools
+
+    def shard(self, token_id):
+        if token_id not in self.shard_of:
+            self.shard_of[token_id] = len(self.shard_of) % len(self.pools)
+        return self.shard_of[token_id]
+
+    async def match(self, orders):
+        batches = {}
+        for o in orders:
+            batches.setdefault(self.shard(o['token_id']), []).append(o)
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(*[loop.run_in_executor(self.pools[i], _match_shard, batch) for i, batch in batches.items()])
+        order_updates = {}
+        trades = []
+        depths = {}
+        for shard_updates, shard_trades, shard_depths in results:
+            order_updates.update(shard_updates)
+            trades += shard_trades
+            depths.update(shard_depths)
+        # stable, so trades of one incoming order keep their sequence
+        trades.sort(key=lambda t: t['party2_order_id'])
+        return order_updates, trades, depths
+
+    async def depth(self):
+        loop = asyncio.get_running_loop()
+        depths = {}
+        for shard_depths in await asyncio.gather(*[loop.run_in_executor(pool, _shard_depth) for pool in self.pools]):
+            depths.update(shard_depths)
+        return depths
+
+    async def dump(self):
+        loop = asyncio.get_running_loop()
+        dumps = {}
+        for shard_dumps in await asyncio.gather(*[loop.run_in_executor(pool, _dump_shard) for pool in self.pools]):
+            dumps.update(shard_dumps)
+        return dumps
+
+    async def restore(self, path, token_ids):
+        # each shard maps the snapshot itself and builds only the books it owns
+        shards = [set() for _ in self.pools]
+        for token_id in sorted(token_ids):
+            shards[self.shard(token_id)].add(token_id)
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(pool, _restore_shard, path, ids) for pool, ids in zip(self.pools, shards)])
+
+    def close(self):
+        for pool in self.pools:
+            pool.shutdown(cancel_futures=True)
@@ -0,0 +1,165 @@
+import asyncio
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from events import Message
+
+
+# Counters, gauges and histograms rendered in the Prometheus text format on
+# /metrics. Every metric is declared at the bottom of this module, so all
+# processes share one registry. When the explorer runs a process per role,
+# each process publishes its values on the bus and the api sums them with its
+# own; otherwise the roles update the api's registry directly.
+
+lock = threading.Lock() # node writes blocks from a worker thread
+registry = {} # name -> metric, in declaration order
+
+TIME_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+SETTLEMENT_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {} # label values -> value
+        registry[name] = self
+
+    def key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with lock:
+            self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=TIME_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # one count per bucket plus +Inf, not cumulative, then the sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+
+def snapshot():
+    # plain, picklable copy of every value in this process
+    with lock:
+        return {name: {key: list(value) if isinstance(value, list) else value for key, value in metric.values.items()}
+                for name, metric in registry.items() if metric.values}
+
+
+def merge(total, values):
+    for key, value in values.items():
+        if key not in total:
+            total[key] = list(value) if isinstance(value, list) else value
+        elif isinstance(value, list):
+            total[key] = [a + b for a, b in zip(total[key], value)]
+        else:
+            total[key] += value
+
+
+def label_text(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escape = lambda value: value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+
+def render(others=()):
+    '''The text exposition of this process's metrics plus the snapshots in others, summed.'''
+    totals = snapshot()
+    for other in others:
+        for name, values in other.items():
+            if name in registry:
+                merge(totals.setdefault(name, {}), values)
+    lines = []
+    for name, metric in registry.items():
+        lines.append(f'# HELP {name} {metric.help}')
+        lines.append(f'# TYPE {name} {metric.kind}')
+        for key, value in sorted(totals.get(name, {}).items()):
+            if metric.kind != 'histogram':
+                lines.append(f'{name}{label_text(metric.labels, key)} {value}')
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.buckets + ('+Inf',), value):
+                cumulative += count
+                lines.append(f'{name}_bucket{label_text(metric.labels, key, [("le", str(bound))])} {cumulative}')
+            lines.append(f'{name}_sum{label_text(metric.labels, key)} {value[-1]}')
+            lines.append(f'{name}_count{label_text(metric.labels, key)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+async def publish(bus, interval=None):
+    # the snapshots of a role process, for the api processes to merge
+    interval = interval or float(os.environ.get("METRICS_INTERVAL", 5))
+    while True:
+        await asyncio.sleep(interval)
+        bus.publish(Message(Message.Type.MetricsUpdated, dict(pid=os.getpid(), metrics=snapshot())))
+
+
+# node.run and Database.save_block_range
+BLOCK_FETCH_SECONDS = Histogram('privx_block_fetch_seconds', 'Time to download one range of blocks from the node.')
+BLOCK_DECODE_SECONDS = Histogram('privx_block_decode_seconds', 'Time to decode the JSON of one range of blocks.')
+BLOCK_COMMIT_SECONDS = Histogram('privx_block_commit_seconds', 'Time to write one range of blocks to Postgres.')
+BLOCKS_SAVED = Counter('privx_blocks_saved_total', 'Blocks written to Postgres.')
+SYNC_ERRORS = Counter('privx_sync_errors_total', 'Failed block sync rounds.')
+CHAIN_HEIGHT = Gauge('privx_chain_height', 'Latest block height, as reported by the node and as stored locally.', ['source'])
+CHAIN_HEIGHT_LAG = Gauge('privx_chain_height_lag', 'Blocks the local database is behind the node.')
+
+# dealer.run and Database.save_matches
+MATCH_SECONDS = Histogram('privx_match_seconds', 'Time to match the orders of one pass.')
+MATCH_SAVE_SECONDS = Histogram('privx_match_save_seconds', 'Time to write the results of one matching pass.')
+MATCH_PASS_ORDERS = Histogram('privx_match_pass_orders', 'Orders fed into the books per matching pass.', buckets=SIZE_BUCKETS)
+MATCH_PASS_TRADES = Histogram('privx_match_pass_trades', 'Trades produced per matching pass.', buckets=SIZE_BUCKETS)
+ORDERS_MATCHED = Counter('privx_orders_matched_total', 'Orders fed into the books.')
+TRADES = Counter('privx_trades_total', 'Trades produced by matching.')
+OPEN_ORDERS = Gauge('privx_open_orders', 'Orders resting in the books.', ['token_id', 'side'])
+
+# contract.run and Database.save_blocks
+KNOCKDOWN_SECONDS = Histogram('privx_knockdown_seconds', 'Time of one knockdown request to the contract host.')
+KNOCKDOWNS = Counter('privx_knockdowns_total', 'Knockdowns per outcome.', ['result'])
+SETTLEMENT_SECONDS = Histogram('privx_settlement_seconds', 'Time from a trade to its knockdown being confirmed in a block.', buckets=SETTLEMENT_BUCKETS)
+SETTLEMENT_BACKLOG = Gauge('privx_settlement_backlog', 'Trades not settled yet, per settlement state.', ['state'])
+
+# api.py
+HTTP_REQUEST_SECONDS = Histogram('privx_http_request_seconds', 'Latency of api requests per route.', ['route'])
+HTTP_REQUESTS = Counter('privx_http_requests_total', 'Api requests per route and status.', ['route', 'status'])
+API_CACHE_REQUESTS = Counter('privx_api_cache_requests_total', 'Cached route lookups: hit, miss, or shared with a computation in flight.', ['route', 'result'])
@@ -0,0 +1,75 @@
+"""initial schema, as created by init_db.py before migrations
+
+Revision ID: 0001
+Revises: 
+Create Date: 2026-10-17 19:10:00.000000
+
+Databases created earlier with init_db.py already have these tables:
+mark them with `alembic stamp 0001` before `alembic upgrade head`.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('block',
+    sa.Column('height', sa.INTEGER(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('updated_at', sa.DateTime(timezone=True), nullable=True),
+    sa.PrimaryKeyConstraint('height')
+    )
+    op.create_table('token',
+    sa.Column('id', sa.INTEGER(), nullable=False),
+    sa.Column('base', sa.String(length=20), nullable=True),
+    sa.Column('quote', sa.String(length=20), nullable=True),
+    sa.Column('symbol', sa.String(length=0), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.execute(sa.schema.CreateSequence(sa.Sequence('order_id_seq', minvalue=0, start=0, increment=1)))
+    op.create_table('order',
+    sa.Column('id', sa.INTEGER(), sa.Sequence('order_id_seq', minvalue=0, start=0, increment=1), nullable=False),
+    sa.Column('type', sa.String(), nullable=False),
+    sa.Column('side', sa.String(), nullable=False),
+    sa.Column('quantity', sa.INTEGER(), nullable=True),
+    sa.Column('origin_quantity', sa.INTEGER(), nullable=True),
+    sa.Column('price', sa.DECIMAL(), nullable=True),
+    sa.Column('sum_price', sa.DECIMAL(), nullable=True),
+    sa.Column('addr', sa.String(length=100), nullable=True),
+    sa.Column('status', sa.String(), nullable=False),
+    sa.Column('height', sa.INTEGER(), nullable=True),
+    sa.Column('token_id', sa.INTEGER(), nullable=True),
+    sa.Column('created_at', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('updated_at', sa.DateTime(timezone=True), nullable=True),
+    sa.ForeignKeyConstraint(['token_id'], ['token.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('trade',
+    sa.Column('id', sa.INTEGER(), nullable=False),
+    sa.Column('price', sa.DECIMAL(), nullable=True),
+    sa.Column('quantity', sa.FLOAT(), nullable=True),
+    sa.Column('party1_order_id', sa.INTEGER(), nullable=True),
+    sa.Column('party2_order_id', sa.INTEGER(), nullable=True),
+    sa.Column('token_id', sa.INTEGER(), nullable=True),
+    sa.Column('created_at', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('updated_at', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('onchain', sa.Boolean(), nullable=True),
+    sa.ForeignKeyConstraint(['party1_order_id'], ['order.id'], ),
+    sa.ForeignKeyConstraint(['party2_order_id'], ['order.id'], ),
+    sa.ForeignKeyConstraint(['token_id'], ['token.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('trade')
+    op.drop_table('order')
+    op.execute(sa.schema.DropSequence(sa.Sequence('order_id_seq')))
+    op.drop_table('token')
+    op.drop_table('block')
@@ -0,0 +1,36 @@
+"""candle table for /api/history
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17 19:10:00.000000
+
+The dealer fills it from the trade history on its next start.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('candle',
+    sa.Column('token_id', sa.INTEGER(), nullable=False),
+    sa.Column('resolution', sa.INTEGER(), nullable=False),
+    sa.Column('time', sa.BIGINT(), nullable=False),
+    sa.Column('open', sa.DECIMAL(), nullable=True),
+    sa.Column('high', sa.DECIMAL(), nullable=True),
+    sa.Column('low', sa.DECIMAL(), nullable=True),
+    sa.Column('close', sa.DECIMAL(), nullable=True),
+    sa.Column('volume', sa.FLOAT(), nullable=True),
+    sa.ForeignKeyConstraint(['token_id'], ['token.id'], ),
+    sa.PrimaryKeyConstraint('token_id', 'resolution', 'time')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('candle')
@@ -0,0 +1,39 @@
+"""indexes for the hot order and trade queries
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17 19:10:00.000000
+
+Built CONCURRENTLY so a live node, dealer and api keep writing meanwhile.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+INDEXES = [
+    ('ix_order_todo_book', 'order', ['token_id', 'side', 'price'], dict(postgresql_where=sa.text("status = 'todo'"))),
+    ('ix_order_addr_id', 'order', ['addr', 'id'], {}),
+    ('ix_trade_offchain_id', 'trade', ['id'], dict(postgresql_where=sa.text('NOT onchain'))),
+    ('ix_trade_token_created_at', 'trade', ['token_id', 'created_at'], {}),
+    ('ix_trade_party1_order_id', 'trade', ['party1_order_id'], {}),
+    ('ix_trade_party2_order_id', 'trade', ['party2_order_id'], {}),
+]
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, columns, kw in INDEXES:
+            op.create_index(name, table, columns, postgresql_concurrently=True, **kw)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, _, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True)
@@ -0,0 +1,42 @@
+"""trade settlement state and knockdown transaction id
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17 19:30:00.000000
+
+Trades already marked onchain become confirmed; the rest are pending.
+The settlement indexes are built CONCURRENTLY, as in 0003, so trades keep
+being written meanwhile.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('trade', sa.Column('settlement', sa.String(), server_default='pending', nullable=False))
+    op.add_column('trade', sa.Column('transaction_id', sa.String(length=100), nullable=True))
+    op.add_column('trade', sa.Column('submitted_at', sa.DateTime(timezone=True), nullable=True))
+    op.execute("UPDATE trade SET settlement = 'confirmed' WHERE onchain")
+    op.alter_column('trade', 'settlement', server_default=None)
+    with op.get_context().autocommit_block():
+        op.create_index('ix_trade_pending_id', 'trade', ['id'], postgresql_where=sa.text("settlement = 'pending'"), postgresql_concurrently=True)
+        op.create_index('ix_trade_submitted_transaction_id', 'trade', ['transaction_id'], postgresql_where=sa.text("settlement = 'submitted'"),
+                        postgresql_concurrently=True)
+        op.drop_index('ix_trade_offchain_id', table_name='trade', postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.create_index('ix_trade_offchain_id', 'trade', ['id'], postgresql_where=sa.text('NOT onchain'), postgresql_concurrently=True)
+        op.drop_index('ix_trade_submitted_transaction_id', table_name='trade', postgresql_concurrently=True)
+        op.drop_index('ix_trade_pending_id', table_name='trade', postgresql_concurrently=True)
+    op.drop_column('trade', 'submitted_at')
+    op.drop_column('trade', 'transaction_id')
+    op.drop_column('trade', 'settlement')
@@ -0,0 +1,25 @@
+"""label weekly candles with their Sunday
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-17 21:30:00.000000
+
+Weekly bars run Monday to Sunday, as pandas '1W' (W-SUN) bins them, and were
+labelled with their Monday; they now carry the Sunday label pandas gives them.
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute("UPDATE candle SET time = time + 6 * 86400 WHERE resolution = 604800")
+
+
+def downgrade() -> None:
+    op.execute("UPDATE candle SET time = time - 6 * 86400 WHERE resolution = 604800")
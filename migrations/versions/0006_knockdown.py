@@ -0,0 +1,44 @@
+"""every knockdown transaction of a trade, and the height it was claimed at
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-17 22:00:00.000000
+
+The transaction ids already recorded become the first knockdowns, and
+trades in flight count as claimed at the current height. The index of the
+submitted trades is swapped CONCURRENTLY, as in 0003.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('knockdown',
+    sa.Column('transaction_id', sa.String(length=100), nullable=False),
+    sa.Column('trade_id', sa.INTEGER(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), nullable=True),
+    sa.ForeignKeyConstraint(['trade_id'], ['trade.id'], ),
+    sa.PrimaryKeyConstraint('transaction_id')
+    )
+    op.execute("INSERT INTO knockdown (transaction_id, trade_id, created_at) SELECT transaction_id, id, submitted_at FROM trade WHERE transaction_id IS NOT NULL")
+    op.add_column('trade', sa.Column('submitted_height', sa.INTEGER(), nullable=True))
+    op.execute("UPDATE trade SET submitted_height = (SELECT max(height) FROM block) WHERE settlement = 'submitted'")
+    with op.get_context().autocommit_block():
+        op.create_index('ix_trade_submitted_at', 'trade', ['submitted_at'], postgresql_where=sa.text("settlement = 'submitted'"), postgresql_concurrently=True)
+        op.drop_index('ix_trade_submitted_transaction_id', table_name='trade', postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.create_index('ix_trade_submitted_transaction_id', 'trade', ['transaction_id'], postgresql_where=sa.text("settlement = 'submitted'"),
+                        postgresql_concurrently=True)
+        op.drop_index('ix_trade_submitted_at', table_name='trade', postgresql_concurrently=True)
+    op.drop_column('trade', 'submitted_height')
+    op.drop_table('knockdown')
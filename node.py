@@ -1,35 +1,79 @@
 import aiohttp
 import os
 import asyncio
+from collections import deque
+from sqlalchemy.exc import SQLAlchemyError
+import metrics
 from db import Database
 
 
-async def run():
+RANGE_SIZE = 50   # blocks per /testnet3/blocks request
+TIMEOUT = aiohttp.ClientTimeout(total=60)
+
+
+async def fetch_blocks(session, node_host, start, end):
+    with metrics.BLOCK_FETCH_SECONDS.time():
+        async with session.get(f"{node_host}/testnet3/blocks?start={start}&end={end}") as block_resp:
+            if not block_resp.ok:
+                raise RuntimeError(f"failed to get blocks {start} to {end - 1}: {block_resp.status}")
+            return await block_resp.read()
+
+
+async def sync_blocks(session, node_host, local_height, latest_height, in_flight):
+    '''
+    Keep up to in_flight range requests downloading while the ranges already
+    fetched are decoded and written to Postgres in a worker thread, strictly
+    in height order, one transaction per range. Any failure cancels the ranges
+    still in flight; the next round resumes from get_db_height.
+    '''
+    pending = deque()
+    next_start = local_height + 1
+    try:
+        while pending or next_start <= latest_height:
+            while len(pending) < in_flight and next_start <= latest_height:
+                end = min(next_start + RANGE_SIZE, latest_height + 1)
+                print(f"fetching blocks {next_start} to {end - 1}")
+                pending.append((next_start, end, asyncio.create_task(fetch_blocks(session, node_host, next_start, end))))
+                next_start = end
+            start, end, task = pending.popleft()
+            body = await task
+            local_height = await asyncio.to_thread(db.save_block_range, start, end, body)
+            metrics.CHAIN_HEIGHT.set(local_height, source='local')
+            metrics.CHAIN_HEIGHT_LAG.set(latest_height - local_height)
+    finally:
+        for _, _, task in pending:
+            task.cancel()
+    return local_height
+
+
+async def run(bus=None):
     global db
     psqlurl = os.environ.get("PSQLURL")
-    db = Database(psqlurl)
+    db = Database(psqlurl, bus)
     node_host = os.environ.get("NODE_HOST", 'http://127.0.0.1:3030')
+    in_flight = int(os.environ.get("SYNC_IN_FLIGHT", 4))
 
-    async with aiohttp.ClientSession() as session:
+    async with aiohttp.ClientSession(timeout=TIMEOUT) as session:
         while True:
             print('sync block-----------------')
-            async with session.get(f"{node_host}/testnet3/latest/height") as resp:
-                if not resp.ok:
-                    print("failed to get latest height")
-                    continue
-                latest_height = int(await resp.text())
+            try:
+                async with session.get(f"{node_host}/testnet3/latest/height") as resp:
+                    if not resp.ok:
+                        raise RuntimeError(f"failed to get latest height: {resp.status}")
+                    latest_height = int(await resp.text())
                 local_height = db.get_db_height()
-                while latest_height > local_height:
+                metrics.CHAIN_HEIGHT.set(latest_height, source='node')
+                metrics.CHAIN_HEIGHT.set(local_height, source='local')
+                metrics.CHAIN_HEIGHT_LAG.set(latest_height - local_height)
+                if latest_height > local_height:
                     print("remote latest height:", latest_height)
-                    start = local_height + 1
-                    end = min(start + 50, latest_height + 1)
-                    print(f"fetching blocks {start} to {end - 1}")
-                    async with session.get(f"{node_host}/testnet3/blocks?start={start}&end={end}") as block_resp:
-                        if not block_resp.ok:
-                            print("failed to get blocks")
-                            continue
-                        for block in await block_resp.json():
-                            local_height = db.save_block(block)
+                    await sync_blocks(session, node_host, local_height, latest_height, in_flight)
+            except (aiohttp.ClientError, asyncio.TimeoutError, RuntimeError, ValueError, SQLAlchemyError) as e:
+                # timeouts, truncated bodies and failed commits alike: drop the range
+                # being written and resume from get_db_height in the next round
+                print(repr(e))
+                db.session.rollback()
+                metrics.SYNC_ERRORS.inc()
             await asyncio.sleep(10)
 
 
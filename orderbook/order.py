@@ -4,14 +4,18 @@ import time, random
 class Order(object):
     '''
     Orders represent the core piece of the exchange. Every bid/ask is an Order.
-    Orders are doubly linked and have helper functions (next_order, prev_order)
-    to help the exchange fullfill orders with quantities larger than a single
-    existing Order.
+    Orders are doubly linked (next_order, prev_order) to help the exchange
+    fullfill orders with quantities larger than a single existing Order.
+    A book holds one Order per resting order, so they use __slots__ instead of
+    a per-instance __dict__.
     '''
-    def __init__(self, quote, order_list):
+    __slots__ = ('timestamp', 'quantity', 'price', 'order_id', 'trade_id',
+                 'next_order', 'prev_order', 'order_list')
+
+    def __init__(self, quote, order_list, numeric=Decimal):
         self.timestamp = int(quote['timestamp']) # integer representing the timestamp of order creation
-        self.quantity = Decimal(quote['quantity']) # decimal representing amount of thing - can be partial amounts
-        self.price = Decimal(quote['price']) # decimal representing price (currency)
+        self.quantity = numeric(quote['quantity']) # decimal (or integer lots) representing amount of thing - can be partial amounts
+        self.price = numeric(quote['price']) # decimal (or integer ticks) representing price (currency)
         self.order_id = int(quote['order_id'])
         self.trade_id = quote['trade_id']
         # doubly linked list to make it easier to re-order Orders for a particular price point
@@ -19,13 +23,6 @@ class Order(object):
         self.prev_order = None
         self.order_list = order_list
 
-    # helper functions to get Orders in linked list
-    def next_order(self):
-        return self.next_order
-
-    def prev_order(self):
-        return self.prev_order
-
     def update_quantity(self, new_quantity, new_timestamp):
         if new_quantity > self.quantity and self.order_list.tail_order != self:
             # check to see that the order is not the last order in list and the quantity is more
@@ -7,19 +7,52 @@ from decimal import Decimal
 from .ordertree import OrderTree
 
 class OrderBook(object):
-    def __init__(self, tick_size = 0.0001):
+    '''
+    With integer=True the book runs on integer ticks and lots: incoming prices
+    are divided by tick_size once, quantities must be whole lots, and matching,
+    comparisons and volume accounting stay on plain Python ints. Trade prices
+    are scaled back with from_ticks (a no-op for tick_size 1).
+    '''
+    def __init__(self, tick_size = 0.0001, integer = False):
         self.tape = deque(maxlen=None) # Index[0] is most recent trade
-        self.bids = OrderTree()
-        self.asks = OrderTree()
+        self.integer = integer
+        self.bids = OrderTree(int if integer else Decimal)
+        self.asks = OrderTree(int if integer else Decimal)
         self.last_tick = None
         self.last_timestamp = 0
-        self.tick_size = tick_size
+        self.tick_size = Decimal(str(tick_size)) if integer else tick_size
         self.time = 0
         self.next_order_id = 0
 
     def update_time(self):
         self.time += 1
 
+    def to_ticks(self, price):
+        if self.tick_size == 1:
+            if type(price) is int:
+                return price
+            ticks = int(price)
+            if ticks != price:
+                sys.exit('to_ticks() given price {} off the tick size {}'.format(price, self.tick_size))
+            return ticks
+        ticks = Decimal(price) / self.tick_size
+        if ticks != ticks.to_integral_value():
+            sys.exit('to_ticks() given price {} off the tick size {}'.format(price, self.tick_size))
+        return int(ticks)
+
+    def from_ticks(self, ticks):
+        if self.tick_size == 1:
+            return ticks
+        return ticks * self.tick_size
+
+    def to_lots(self, quantity):
+        if type(quantity) is int:
+            return quantity
+        lots = int(quantity)
+        if lots != quantity:
+            sys.exit('to_lots() given fractional quantity {}'.format(quantity))
+        return lots
+
     def process_order(self, quote, from_data, verbose):
         order_type = quote['type']
         order_in_book = None
@@ -30,12 +63,14 @@ class OrderBook(object):
             quote['timestamp'] = self.time
         if quote['quantity'] <= 0:
             sys.exit('process_order() given order of quantity <= 0')
+        if self.integer:
+            quote['quantity'] = self.to_lots(quote['quantity'])
         if not from_data:
             self.next_order_id += 1
         if order_type == 'market':
             trades = self.process_market_order(quote, verbose)
         elif order_type == 'limit':
-            quote['price'] = Decimal(quote['price'])
+            quote['price'] = self.to_ticks(quote['price']) if self.integer else Decimal(quote['price'])
             trades, order_in_book = self.process_limit_order(quote, from_data, verbose)
         else:
             sys.exit("order_type for process_order() is neither 'market' or 'limit'")
@@ -58,6 +93,11 @@ class OrderBook(object):
                 # Do the transaction
                 new_book_quantity = head_order.quantity - quantity_to_trade
                 head_order.update_quantity(new_book_quantity, head_order.timestamp)
+                # update_quantity only adjusts the OrderList, keep the tree total in step
+                if side == 'bid':
+                    self.bids.volume -= quantity_to_trade
+                else:
+                    self.asks.volume -= quantity_to_trade
                 quantity_to_trade = 0
             elif quantity_to_trade == head_order.quantity:
                 traded_quantity = quantity_to_trade
@@ -78,7 +118,7 @@ class OrderBook(object):
 
             transaction_record = {
                     'timestamp': self.time,
-                    'price': traded_price,
+                    'price': self.from_ticks(traded_price) if self.integer else traded_price,
                     'quantity': traded_quantity,
                     'time': self.time
                     }
@@ -168,6 +208,9 @@ class OrderBook(object):
         side = order_update['side']
         order_update['order_id'] = order_id
         order_update['timestamp'] = self.time
+        if self.integer:
+            order_update['price'] = self.to_ticks(order_update['price'])
+            order_update['quantity'] = self.to_lots(order_update['quantity'])
         if side == 'bid':
             if self.bids.order_exists(order_update['order_id']):
                 self.bids.update_order(order_update)
@@ -178,7 +221,7 @@ class OrderBook(object):
             sys.exit('modify_order() given neither "bid" nor "ask"')
 
     def get_volume_at_price(self, side, price):
-        price = Decimal(price)
+        price = self.to_ticks(price) if self.integer else Decimal(price)
         if side == 'bid':
             volume = 0
             if self.bids.price_exists(price):
@@ -192,6 +235,27 @@ class OrderBook(object):
         else:
             sys.exit('get_volume_at_price() given neither "bid" nor "ask"')
 
+    def get_depth(self, side, levels=None):
+        '''
+        Aggregated L2 view of one side: [(price, volume)], best price first,
+        at most levels entries. Level volumes are maintained by the OrderLists
+        on every insert, fill and cancel, so this only walks the price keys.
+        '''
+        if side == 'bid':
+            price_map = self.bids.price_map
+            keys = reversed(price_map.keys())
+        elif side == 'ask':
+            price_map = self.asks.price_map
+            keys = iter(price_map.keys())
+        else:
+            sys.exit('get_depth() given neither "bid" nor "ask"')
+        depth = []
+        for price in keys:
+            if levels is not None and len(depth) >= levels:
+                break
+            depth.append((self.from_ticks(price) if self.integer else price, price_map[price].volume))
+        return depth
+
     def get_best_bid(self):
         return self.bids.max_price()
 
@@ -7,35 +7,28 @@ class OrderList(object):
     OrderList makes this easy to do. OrderList is naturally arranged by time.
     Orders at the front of the list have priority.
     '''
+    __slots__ = ('head_order', 'tail_order', 'length', 'volume')
 
     def __init__(self):
         self.head_order = None # first order in the list
         self.tail_order = None # last order in the list
         self.length = 0 # number of Orders in the list
         self.volume = 0 # sum of Order quantity in the list AKA share volume
-        self.last = None # helper for iterating
 
     def __len__(self):
         return self.length
 
     def __iter__(self):
-        self.last = self.head_order
-        return self
+        '''Walk the orders from head to tail.
 
-    def next(self):
-        '''Get the next order in the list.
-
-        Set self.last as the next order. If there is no next order, stop
-        iterating through list.
+        The cursor lives in the generator rather than on the OrderList, so
+        nested or concurrent iterations do not disturb each other.
         '''
-        if self.last == None:
-            raise StopIteration
-        else:
-            return_value = self.last
-            self.last = self.last.next_order
-            return return_value
-
-    __next__ = next # python3
+        order = self.head_order
+        while order is not None:
+            next_order = order.next_order
+            yield order
+            order = next_order
 
     def get_head_order(self):
         return self.head_order
@@ -1,3 +1,4 @@
+from decimal import Decimal
 from sortedcontainers import SortedDict
 from .orderlist import OrderList
 from .order import Order
@@ -9,7 +10,8 @@ class OrderTree(object):
     Keeping the information in a red black tree makes it easier/faster to detect a match.
     '''
 
-    def __init__(self):
+    def __init__(self, numeric=Decimal):
+        self.numeric = numeric # Decimal, or int when the book runs on integer ticks/lots
         self.price_map = SortedDict() # Dictionary containing price : OrderList object
         self.prices = self.price_map.keys()
         self.order_map = {} # Dictionary containing order_id : Order object
@@ -47,7 +49,7 @@ class OrderTree(object):
         self.num_orders += 1
         if quote['price'] not in self.price_map:
             self.create_price(quote['price']) # If price not in Price Map, create a node in RBtree
-        order = Order(quote, self.price_map[quote['price']]) # Create an order
+        order = Order(quote, self.price_map[quote['price']], self.numeric) # Create an order
         self.price_map[order.price].append_order(order) # Add the order to the OrderList in Price Map
         self.order_map[order.order_id] = order
         self.volume += order.quantity
@@ -0,0 +1,264 @@
+#! /usr/bin/python
+'''
+Reproducible OrderBook benchmark.
+
+Every workload is a seeded stream of actions fed to a fresh OrderBook in a
+child process. The run reports orders/sec, p50/p99 per-action latency, net
+allocated blocks and peak RSS, checks the book invariants afterwards, and
+prints everything as JSON so runs can be compared across commits.
+
+usage:
+    python benchmark.py                                # all workloads
+    python benchmark.py -w crossing -n 200000 --integer
+    python benchmark.py -w cancel --record cancel.jsonl
+    python benchmark.py --replay cancel.jsonl -o result.json
+'''
+from __future__ import print_function
+import argparse
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from orderbook import OrderBook
+
+# An action is ('order', quote) or ('cancel', side, order_id). OrderBook numbers
+# every processed order from 1 upwards, so generators can predict order ids.
+
+
+def limit(side, quantity, price, trade_id):
+    return ('order', {'type': 'limit', 'side': side, 'quantity': quantity, 'price': price, 'trade_id': trade_id})
+
+
+def market(side, quantity, trade_id):
+    return ('order', {'type': 'market', 'side': side, 'quantity': quantity, 'trade_id': trade_id})
+
+
+def resting(rand, trade_id):
+    '''A limit order that never crosses: bids at or below 1000, asks above.'''
+    if rand.random() < 0.5:
+        return limit('bid', rand.randint(1, 1000), rand.randint(900, 1000), trade_id)
+    return limit('ask', rand.randint(1, 1000), rand.randint(1001, 1100), trade_id)
+
+
+def add_only(nb_actions, seed):
+    rand = random.Random(seed)
+    for trade_id in range(nb_actions):
+        yield resting(rand, trade_id)
+
+
+def crossing(nb_actions, seed):
+    '''Prices overlap around 1000, so roughly every other order trades.'''
+    rand = random.Random(seed)
+    for trade_id in range(nb_actions):
+        side = rand.choice(('bid', 'ask'))
+        yield limit(side, rand.randint(1, 1000), rand.randint(980, 1020), trade_id)
+
+
+def cancel_heavy(nb_actions, seed):
+    '''A quarter of the stream builds the book, then 60% of actions cancel a random resting order.'''
+    rand = random.Random(seed)
+    live = [] # (side, order_id) of orders still resting
+    order_id = 0
+    for trade_id in range(nb_actions):
+        if live and trade_id >= nb_actions // 4 and rand.random() < 0.6:
+            index = rand.randrange(len(live))
+            live[index], live[-1] = live[-1], live[index]
+            side, cancel_id = live.pop()
+            yield ('cancel', side, cancel_id)
+        else:
+            action = resting(rand, trade_id)
+            order_id += 1
+            live.append((action[1]['side'], order_id))
+            yield action
+
+
+def deep_sweep(nb_actions, seed):
+    '''One-lot resting orders, swept by market orders that each take 200 of them.'''
+    rand = random.Random(seed)
+    for trade_id in range(nb_actions):
+        if trade_id % 100 == 99:
+            yield market(rand.choice(('bid', 'ask')), 200, trade_id)
+        else:
+            action = resting(rand, trade_id)
+            action[1]['quantity'] = 1
+            yield action
+
+
+def replay(path):
+    '''Stream actions recorded with --record: one JSON object per line.'''
+    with open(path) as f:
+        for line in f:
+            action = json.loads(line)
+            if action.pop('op') == 'cancel':
+                yield ('cancel', action['side'], action['order_id'])
+            else:
+                yield ('order', action)
+
+
+WORKLOADS = {
+    'add': add_only,
+    'crossing': crossing,
+    'cancel': cancel_heavy,
+    'sweep': deep_sweep,
+}
+
+
+def record(actions, path):
+    with open(path, 'w') as f:
+        for action in actions:
+            if action[0] == 'cancel':
+                f.write(json.dumps({'op': 'cancel', 'side': action[1], 'order_id': action[2]}) + '\n')
+            else:
+                f.write(json.dumps(dict(action[1], op='order')) + '\n')
+
+
+def check_book(order_book):
+    '''The invariants every workload must leave behind.'''
+    for tree in (order_book.bids, order_book.asks):
+        volume = 0
+        for price, order_list in tree.price_map.items():
+            assert len(order_list) > 0, 'empty price level %s left in tree' % price
+            level_volume = sum(order.quantity for order in order_list)
+            assert level_volume == order_list.volume, 'level volume out of sync at %s' % price
+            assert len(list(order_list)) == len(order_list), 'level length out of sync at %s' % price
+            volume += level_volume
+        assert volume == tree.volume, 'tree volume out of sync'
+        assert len(tree.price_map) == tree.depth, 'tree depth out of sync'
+    best_bid, best_ask = order_book.get_best_bid(), order_book.get_best_ask()
+    assert best_bid is None or best_ask is None or best_bid < best_ask, 'book is crossed'
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def run_workload(actions, integer, trace):
+    actions = list(actions) # generated before the clock starts
+    order_book = OrderBook(tick_size=1, integer=True) if integer else OrderBook()
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    latencies = []
+    nb_trades = traded = 0
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    if trace:
+        tracemalloc.start()
+    clock = time.perf_counter_ns
+    started = clock()
+    for action in actions:
+        begin = clock()
+        if action[0] == 'cancel':
+            order_book.cancel_order(action[1], action[2])
+        else:
+            trades, _ = order_book.process_order(action[1], False, False)
+            nb_trades += len(trades)
+            for trade in trades:
+                traded += trade['quantity']
+        latencies.append(clock() - begin)
+    elapsed = clock() - started
+    peak_traced = tracemalloc.get_traced_memory()[1] if trace else None
+    if trace:
+        tracemalloc.stop()
+    allocated_blocks = sys.getallocatedblocks() - blocks
+    check_book(order_book)
+    latencies.sort()
+    return {
+        'actions': len(actions),
+        'trades': nb_trades,
+        'traded_quantity': str(traded),
+        'resting_orders': len(order_book.bids) + len(order_book.asks),
+        'seconds': elapsed / 1e9,
+        'orders_per_sec': len(actions) / (elapsed / 1e9) if elapsed else 0,
+        'latency_ns': {
+            'p50': percentile(latencies, 0.50),
+            'p99': percentile(latencies, 0.99),
+            'max': latencies[-1] if latencies else 0,
+        },
+        'allocated_blocks': allocated_blocks,
+        'peak_traced_bytes': peak_traced,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'base_rss_kb': base_rss,
+    }
+
+
+def _child(conn, name, nb_actions, seed, replay_path, integer, trace):
+    try:
+        actions = replay(replay_path) if replay_path else WORKLOADS[name](nb_actions, seed)
+        conn.send(run_workload(actions, integer, trace))
+    except BaseException as e:
+        conn.send({'error': repr(e)})
+    conn.close()
+
+
+def run_isolated(name, nb_actions, seed, replay_path, integer, trace):
+    '''Run one workload in a fresh process so peak RSS belongs to it alone.'''
+    parent, child = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_child, args=(child, name, nb_actions, seed, replay_path, integer, trace))
+    process.start()
+    result = parent.recv()
+    process.join()
+    if 'error' in result:
+        sys.exit('workload %s failed: %s' % (name, result['error']))
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='OrderBook matching benchmark')
+    parser.add_argument('-w', '--workload', action='append', choices=sorted(WORKLOADS), help='workload to run (repeatable), default: all')
+    parser.add_argument('-n', '--actions', type=int, default=100000, help='actions per workload')
+    parser.add_argument('-s', '--seed', type=int, default=1)
+    parser.add_argument('--integer', action='store_true', help='run the book on integer ticks/lots')
+    parser.add_argument('--tracemalloc', action='store_true', help='also report peak traced bytes (slows the run)')
+    parser.add_argument('--replay', help='replay a recorded action stream instead of generating one')
+    parser.add_argument('--record', help='write the generated stream of the single selected workload and exit')
+    parser.add_argument('-o', '--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    if args.record:
+        if not args.workload or len(args.workload) != 1:
+            sys.exit('--record needs exactly one --workload')
+        record(WORKLOADS[args.workload[0]](args.actions, args.seed), args.record)
+        return
+
+    if args.replay:
+        names = ['replay:' + os.path.basename(args.replay)]
+    else:
+        names = args.workload or sorted(WORKLOADS)
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': args.seed,
+        'integer': args.integer,
+        'workloads': {},
+    }
+    for name in names:
+        report['workloads'][name] = run_isolated(name, args.actions, args.seed, args.replay, args.integer, args.tracemalloc)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#! /usr/bin/python
+'''
+Bytes per resting order, for the slotted Order/OrderList and for __dict__
+backed equivalents (what the classes were before they got __slots__).
+
+usage: python memory.py [nb_orders]
+'''
+from __future__ import print_function
+import gc
+import os
+import random
+import sys
+import tracemalloc
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from orderbook import OrderBook
+from orderbook import ordertree
+from orderbook.order import Order
+from orderbook.orderlist import OrderList
+
+
+class DictOrder(Order):
+    pass # no __slots__, so instances get a __dict__ again
+
+
+class DictOrderList(OrderList):
+    pass
+
+
+def resting_orders(nb_orders, seed=1):
+    rand = random.Random(seed)
+    for trade_id in range(nb_orders):
+        if trade_id % 2:
+            yield {'type': 'limit', 'side': 'bid', 'quantity': rand.randint(1, 1000), 'price': rand.randint(900, 1000), 'trade_id': trade_id}
+        else:
+            yield {'type': 'limit', 'side': 'ask', 'quantity': rand.randint(1, 1000), 'price': rand.randint(1001, 1100), 'trade_id': trade_id}
+
+
+def bytes_per_order(nb_orders, integer):
+    quotes = list(resting_orders(nb_orders)) # allocated before the measurement starts
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    order_book = OrderBook(tick_size=1, integer=True) if integer else OrderBook()
+    for quote in quotes:
+        order_book.process_order(quote, False, False)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    assert len(order_book.bids) + len(order_book.asks) == nb_orders, 'orders should all rest'
+    return (after - before) / float(nb_orders)
+
+
+def measure(nb_orders, order_class, order_list_class):
+    ordertree.Order, ordertree.OrderList = order_class, order_list_class
+    try:
+        return bytes_per_order(nb_orders, False), bytes_per_order(nb_orders, True)
+    finally:
+        ordertree.Order, ordertree.OrderList = Order, OrderList
+
+
+if __name__ == '__main__':
+    nb_orders = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    for name, classes in (('__dict__', (DictOrder, DictOrderList)), ('__slots__', (Order, OrderList))):
+        decimal_bytes, integer_bytes = measure(nb_orders, *classes)
+        print('%-9s decimal: %6.1f bytes/order  integer: %6.1f bytes/order' % (name, decimal_bytes, integer_bytes))
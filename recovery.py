@@ -0,0 +1,225 @@
+import asyncio
+import mmap
+import os
+import time
+import numpy as np
+from orderbook import OrderBook
+
+
+# Crash recovery of the dealer's books. A snapshot holds the resting orders of
+# every book, and the journal every order fed into the books since, written
+# before the pass that matches it. A restart maps the snapshot, rebuilds the
+# books from it and matches the journaled orders again, instead of replaying
+# every todo order in Postgres. Both files are flat arrays of fixed size
+# records read through numpy views of a memory map.
+
+MAGIC = b'PRIVXOB1'
+HEADER = np.dtype([('last_order_id', '<i8'), ('last_trade_id', '<i8'), ('books', '<i8')])
+BOOK = np.dtype([('token_id', '<i8'), ('version', '<i8'), ('time', '<i8'), ('next_order_id', '<i8'), ('orders', '<i8')])
+# bids then asks, each side by ascending price, each price level in queue order
+ORDER = np.dtype([('side', 'u1'), ('price', '<u8'), ('quantity', '<u8'), ('order_id', '<i8'), ('trade_id', '<i8'), ('timestamp', '<i8')])
+# an order as matcher.match takes it; a COMMITTED record ends a pass whose matches
+# are saved, with the last order id of the pass and the last trade id saved so far
+INPUT = np.dtype([('id', '<i8'), ('token_id', '<i8'), ('type', 'u1'), ('side', 'u1'), ('price', '<u8'), ('quantity', '<u8')])
+TYPES = ('limit', 'market')
+SIDES = ('bid', 'ask')
+COMMITTED = 255
+
+
+def dump_book(book):
+    '''(time, next_order_id, ORDER array) of an integer OrderBook, see matcher.match.'''
+    rows = []
+    for side, tree in enumerate((book.bids, book.asks)):
+        for price, order_list in tree.price_map.items():
+            rows += [(side, price, order.quantity, order.order_id, order.trade_id, order.timestamp) for order in order_list]
+    return book.time, book.next_order_id, np.array(rows, dtype=ORDER)
+
+
+def write_snapshot(path, last_order_id, last_trade_id, versions, books):
+    # books: token_id -> dump_book(book); the old snapshot stays until the new one is complete
+    table = np.array([(token_id, versions.get(token_id, -1), book_time, next_order_id, len(orders))
+                      for token_id, (book_time, next_order_id, orders) in books.items()], dtype=BOOK)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.array([(last_order_id, last_trade_id, len(table))], dtype=HEADER).tobytes())
+        f.write(table.tobytes())
+        for _, _, orders in books.values():
+            f.write(orders.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+
+def read_snapshot(path):
+    '''(HEADER record, BOOK table, token_id -> ORDER array) of the snapshot at path, None without one.'''
+    try:
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError): # an empty file cannot be mapped
+        return None
+    if data[:len(MAGIC)] != MAGIC:
+        return None
+    header = np.frombuffer(data, HEADER, 1, len(MAGIC))[0]
+    offset = len(MAGIC) + HEADER.itemsize
+    table = np.frombuffer(data, BOOK, int(header['books']), offset)
+    offset += table.nbytes
+    orders = {}
+    for token_id, count in table[['token_id', 'orders']].tolist():
+        orders[token_id] = np.frombuffer(data, ORDER, count, offset)
+        offset += ORDER.itemsize * count
+    return header, table, orders
+
+
+def load_books(path, token_ids):
+    # the books of token_ids in the snapshot at path, orders inserted in queue order
+    _, table, orders = read_snapshot(path)
+    books = {}
+    for token_id, book_time, next_order_id in table[['token_id', 'time', 'next_order_id']].tolist():
+        if token_id not in token_ids:
+            continue
+        book = books[token_id] = OrderBook(tick_size=1, integer=True)
+        book.time = book_time
+        book.next_order_id = next_order_id
+        trees = (book.bids, book.asks)
+        for side, price, quantity, order_id, trade_id, timestamp in orders[token_id].tolist():
+            trees[side].insert_order(dict(price=price, quantity=quantity, order_id=order_id, trade_id=trade_id, timestamp=timestamp))
+    return books
+
+
+class Journal:
+    '''Append-only file of the INPUT records fed into the books since the snapshot.'''
+    def __init__(self, path):
+        self.file = open(path, 'ab')
+        # a record torn by a crash is dropped, so later ones stay aligned
+        self.file.truncate(self.file.tell() - self.file.tell() % INPUT.itemsize)
+        self.file.seek(0, os.SEEK_END)
+
+    def __len__(self):
+        return self.file.tell() // INPUT.itemsize
+
+    def write(self, records, sync):
+        self.file.write(np.array(records, dtype=INPUT).tobytes())
+        self.file.flush()
+        if sync:
+            os.fsync(self.file.fileno())
+
+    def append(self, orders):
+        # on disk before the matches of orders can be saved
+        self.write([(o['trade_id'], o['token_id'], TYPES.index(o['type']), SIDES.index(o['side']), int(o['price'] or 0), int(o['quantity']))
+                    for o in orders], sync=True)
+
+    def commit(self, last_order_id, last_trade_id):
+        # without it recovery asks Postgres whether the pass was saved, so it needs no fsync
+        self.write([(last_order_id, last_trade_id, COMMITTED, 0, 0, 0)], sync=False)
+
+    def read(self):
+        '''
+        (committed orders, orders of a last pass without its COMMITTED record,
+        last trade id of the last COMMITTED record or None), in journal order.
+        '''
+        committed, orders, last_trade_id = [], [], None
+        if not len(self):
+            return committed, orders, last_trade_id
+        with open(self.file.name, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        for id_, token_id, type_, side, price, quantity in np.frombuffer(data, INPUT, len(self)).tolist():
+            if type_ == COMMITTED:
+                committed += orders
+                orders, last_trade_id = [], token_id
+            else:
+                orders.append(dict(trade_id=id_, token_id=token_id, type=TYPES[type_], side=SIDES[side], price=price, quantity=quantity))
+        return committed, orders, last_trade_id
+
+    def reset(self):
+        self.file.truncate(0)
+        # truncate leaves the position, which __len__ reads, at the old end
+        self.file.seek(0)
+        self.file.flush()
+
+
+class MatchState:
+    '''
+    Snapshot and journal of the books in directory. The dealer journals the
+    orders of each pass before matching them and marks the pass committed once
+    its matches are saved; every interval seconds the books are written to a
+    new snapshot and the journal starts over.
+
+    The files describe the books of one database: trades are only written by
+    the dealer, so the last trade id they know must be the last one in
+    Postgres. If it is not, they are dropped and the books replayed from the
+    todo orders as before.
+    '''
+    def __init__(self, directory, interval):
+        os.makedirs(directory, exist_ok=True)
+        self.snapshot_path = os.path.join(directory, 'books.snapshot')
+        self.journal = Journal(os.path.join(directory, 'orders.journal'))
+        self.interval = interval
+        self.snapshot_at = None # time.monotonic() of the last snapshot, None before the first
+        self.last_trade_id = -1
+
+    async def restore(self, matcher, db):
+        '''Rebuild the books in matcher, returns (last_order_id, versions), (-1, {}) to replay the todo orders.'''
+        start = time.perf_counter()
+        last_order, self.last_trade_id = db.get_last_ids()
+        snapshot = read_snapshot(self.snapshot_path)
+        committed, pending, last_trade_id = self.journal.read()
+        if snapshot is None and not committed and not pending:
+            self.journal.reset()
+            return -1, {}
+        last_order_id, known_trade_id, versions = -1, -1, {}
+        if snapshot is not None:
+            header, table, _ = snapshot
+            last_order_id, known_trade_id = int(header['last_order_id']), int(header['last_trade_id'])
+            versions = dict(table[['token_id', 'version']].tolist())
+        # orders up to the snapshot are still journaled when a crash came before the journal was reset
+        committed = [o for o in committed if o['trade_id'] > last_order_id]
+        pending = [o for o in pending if o['trade_id'] > last_order_id]
+        if committed:
+            known_trade_id = last_trade_id
+        if pending:
+            saved = db.get_last_trade_id([o['trade_id'] for o in pending])
+            if saved is not None:
+                # saved, the crash came before the COMMITTED record
+                committed, pending, known_trade_id = committed + pending, [], saved
+        orders = committed + pending
+        end = orders[-1]['trade_id'] if orders else last_order_id
+        if known_trade_id != self.last_trade_id or end > last_order:
+            print('match state does not fit the database, replaying all orders')
+            if os.path.exists(self.snapshot_path):
+                os.remove(self.snapshot_path)
+            self.journal.reset()
+            return -1, {}
+        if snapshot is not None:
+            await matcher.restore(self.snapshot_path, set(versions))
+            self.snapshot_at = time.monotonic()
+        if committed:
+            await matcher.match(committed)
+        if pending:
+            # the pass the crash interrupted, its matches were never saved
+            order_updates, trades, _ = await matcher.match(pending)
+            db.save_matches(order_updates, trades)
+            self.commit(pending, trades)
+        for o in orders:
+            versions[o['token_id']] = o['trade_id']
+        print(f'restored {len(versions)} books and replayed {len(orders)} journaled orders in {time.perf_counter() - start:.2f}s')
+        return end, versions
+
+    def append(self, orders):
+        if orders:
+            self.journal.append(orders)
+
+    def commit(self, orders, trades):
+        # trades as save_matches left them, with their ids
+        if trades:
+            self.last_trade_id = max(trade['id'] for trade in trades)
+        if orders:
+            self.journal.commit(orders[-1]['trade_id'], self.last_trade_id)
+
+    async def checkpoint(self, matcher, last_order_id, versions):
+        # a new snapshot once interval seconds passed since the last one, or right after a replay
+        if not len(self.journal) or (self.snapshot_at is not None and time.monotonic() - self.snapshot_at < self.interval):
+            return
+        books = await matcher.dump()
+        await asyncio.to_thread(write_snapshot, self.snapshot_path, last_order_id, self.last_trade_id, versions, books)
+        self.journal.reset()
+        self.snapshot_at = time.monotonic()
@@ -0,0 +1,15 @@
+import os
+import sys
+import pytest
+
+# the services import each other as top level modules, as main.py runs them
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+@pytest.fixture
+def psqlurl():
+    # tests against Postgres need a database init_db.py created, they are skipped without one
+    url = os.environ.get("PSQLURL")
+    if not url:
+        pytest.skip("PSQLURL is not set")
+    return url
@@ -0,0 +1,104 @@
+import asyncio
+import socket
+import aiohttp
+import pytest
+from aiohttp import web
+import contract
+
+
+class Recorder:
+    # the transaction ids contract.submit records, in place of the database
+    def __init__(self):
+        self.transactions = []
+
+    def record_transaction(self, trade_id, transaction_id):
+        self.transactions.append((trade_id, transaction_id))
+
+
+def trade(trade_id, buy_order_id, sell_order_id):
+    return dict(id=trade_id, token_id=1, buy_order_id=buy_order_id, sell_order_id=sell_order_id)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def settle(monkeypatch, trades, answers, retries=3, serve=True):
+    '''
+    Settles trades against a contract host answering each POST with the next
+    of answers, or the answer to its buy order when answers is a dict: a status
+    code, 'hang' to never answer, 'drop' to close the connection. Returns the
+    results, the inputs POSTed and the ids recorded.
+    '''
+    posted, db = [], Recorder()
+
+    async def execute(request):
+        inputs = (await request.json())['inputs']
+        posted.append(inputs)
+        answer = answers[inputs[0]] if isinstance(answers, dict) else answers.pop(0)
+        if answer == 'hang':
+            await asyncio.sleep(10)
+        if answer == 'drop':
+            request.transport.close()
+            await asyncio.sleep(10)
+        return web.json_response(f'at1test{len(posted)}', status=answer)
+
+    port = free_port()
+    runner = web.AppRunner(web.Application())
+    runner.app.router.add_post('/testnet3/execute', execute)
+    await runner.setup()
+    if serve:
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+    monkeypatch.setattr(contract, 'db', db, raising=False)
+    monkeypatch.setattr(contract, 'contract_name', 'privx_test.aleo', raising=False)
+    monkeypatch.setattr(contract, 'private_key', 'APrivateKeytest', raising=False)
+    monkeypatch.setattr(contract, 'contract_url', f'http://127.0.0.1:{port}/testnet3/execute', raising=False)
+    try:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=0.5)) as session:
+            results = await contract.settle(session, asyncio.Semaphore(4), trades, retries)
+    finally:
+        await runner.cleanup()
+    return results, posted, db.transactions
+
+
+@pytest.mark.parametrize('answer', ['hang', 'drop', 500, 503])
+def test_sent_knockdowns_are_not_sent_again(monkeypatch, answer):
+    results, posted, recorded = asyncio.run(settle(monkeypatch, [trade(1, 10, 11)], [answer, 200]))
+    assert results == [('unknown', None)]
+    assert len(posted) == 1 and not recorded
+
+
+def test_rejected_knockdowns_fail(monkeypatch):
+    results, posted, _ = asyncio.run(settle(monkeypatch, [trade(1, 10, 11), trade(2, 20, 21)], [400, 200]))
+    assert sorted(results) == [('failed', None), ('submitted', 'at1test2')]
+    assert len(posted) == 2
+
+
+def test_refused_connections_are_retried(monkeypatch):
+    backoff = []
+
+    async def sleep(delay):
+        backoff.append(delay)
+
+    monkeypatch.setattr(asyncio, 'sleep', sleep)
+    results, posted, recorded = asyncio.run(settle(monkeypatch, [trade(1, 10, 11)], [], serve=False))
+    assert results == [('pending', None)] and not posted and not recorded
+    assert backoff == [1, 2, 4]
+
+
+def test_submitted_knockdowns_are_recorded(monkeypatch):
+    results, posted, recorded = asyncio.run(settle(monkeypatch, [trade(1, 10, 11), trade(2, 10, 12)], [200, 200]))
+    assert results == [('submitted', 'at1test1'), ('submitted', 'at1test2')]
+    assert posted == [['10u64', '11u64'], ['10u64', '12u64']]
+    assert recorded == [(1, 'at1test1'), (2, 'at1test2')]
+
+
+def test_trades_wait_for_their_orders(monkeypatch):
+    # 2 and 3 share an order with 1, 5 with 4; 6 is independent
+    trades = [trade(1, 10, 11), trade(2, 10, 12), trade(3, 13, 11), trade(4, 20, 21), trade(5, 22, 21), trade(6, 30, 31)]
+    results, posted, _ = asyncio.run(settle(monkeypatch, trades, {'10u64': 'hang', '20u64': 400, '30u64': 200}))
+    assert len(posted) == 3
+    # sent without an answer: held with it until the stale requeue; after a rejection: never sent, back to pending
+    assert [state for state, _ in results] == ['unknown', 'unknown', 'unknown', 'failed', 'pending', 'submitted']
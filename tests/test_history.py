@@ -0,0 +1,86 @@
+import datetime
+import random
+import pytest
+from sqlalchemy import select, update
+from sqlalchemy.orm import Session
+from db import Database
+from db.db import _history_arrays, _history_columns, _resample_history
+from db.models import Trade
+
+
+BASE = datetime.datetime(2023, 11, 1, tzinfo=datetime.timezone.utc)
+RESOLUTIONS = ['1Min', '5Min', '7Min', '15Min', '30Min', '45Min', '60Min', '90Min', '2H', '1D', '2D', '3D', '1W', 'W', 'W-MON', 'M']
+
+
+def blocks(db, seed, count=80):
+    # blocks of random orders on both markets, as the node returns them
+    rand = random.Random(seed)
+    for height in range(10**9, 10**9 + count):
+        transactions = [dict(status='accepted', type='execute', transaction=dict(id=f'at1test{height}x{i}', execution=dict(transitions=[
+            dict(program=db.contract_name, function=rand.choice(('buy', 'sell', 'buy_2', 'sell_2')),
+                 finalize=[f'aleo1test{rand.randint(0, 9)}', f'{rand.randint(1, 50)}u64', f'{rand.randint(95, 105)}u64'])])))
+            for i in range(rand.randint(0, 6))]
+        yield dict(header=dict(metadata=dict(height=height, timestamp=int(BASE.timestamp()))), transactions=transactions)
+
+
+def trade(db, seed):
+    '''
+    Matches the orders of the blocks and spreads the trades from BASE with
+    gaps from none to more than a day, returns the time of the last one.
+    '''
+    books, last = {}, -1
+    for block in blocks(db, seed):
+        db.save_blocks([block])
+        orders = db.load_valid_orders({'status': 'todo', 'after_id': last})
+        db.match_orders(books, orders)
+        if orders:
+            last = orders[-1]['trade_id']
+    rand = random.Random(seed)
+    created_at = BASE
+    for trade_id in db.session.scalars(select(Trade.id).order_by(Trade.id)).all():
+        created_at += datetime.timedelta(seconds=rand.choice([0, 5, 30, 200, 4000, 90000]), microseconds=rand.randint(0, 999999))
+        db.session.execute(update(Trade).where(Trade.id == trade_id).values(created_at=created_at))
+    db.session.commit()
+    return created_at
+
+
+def windows(last):
+    day = lambda **kwargs: BASE + datetime.timedelta(**kwargs)
+    return [
+        (None, None), (day(days=2, seconds=17), None), (None, day(days=9, seconds=13)), (day(days=3, seconds=1), day(days=5, seconds=7)),
+        (last + datetime.timedelta(days=1), None), (None, day(days=-1)), (day(days=5), day(days=3)),
+        (day(days=4, hours=3, minutes=7), day(days=4, hours=3, minutes=9)), (day(days=-3), last + datetime.timedelta(days=3)),
+        (day(days=4), day(days=11)), (day(days=4, seconds=1), day(days=10, seconds=-1)), (day(days=11, seconds=7), None),
+    ]
+
+
+def values(history):
+    if history['s'] != 'ok':
+        return history
+    return dict(s='ok', **{name: [int(x) if name == 't' else float(x) for x in history[name]] for name in 'tohlcv'})
+
+
+@pytest.mark.parametrize('bins', ['sql', 'numpy'])
+def test_history_matches_pandas(psqlurl, bins):
+    '''
+    load_history, binned by Postgres or by numpy (HISTORY_BINS), returns the
+    bars the pandas resample returns for every market, resolution and window,
+    gaps and windows without trades included. It runs in a transaction rolled
+    back at the end, the commits only release savepoints.
+    '''
+    db = Database(psqlurl)
+    db.history_bins = bins
+    with db.engine.connect() as conn:
+        transaction = conn.begin()
+        db.session = Session(bind=conn, join_transaction_mode='create_savepoint')
+        last = trade(db, seed=3)
+        mismatches = []
+        for symbol in (None, 'TK1-LEO', 'TK2-LEO'):
+            columns = db.session.execute(_history_arrays(_history_columns(symbol))).one()
+            for resolution in RESOLUTIONS:
+                for tm_from, tm_to in windows(last):
+                    if values(db.load_history(symbol, tm_from, tm_to, resolution)) != values(_resample_history(columns, tm_from, tm_to, resolution)):
+                        mismatches.append((symbol, resolution, tm_from, tm_to))
+        transaction.rollback()
+    db.engine.dispose()
+    assert not mismatches
@@ -0,0 +1,110 @@
+import datetime
+import pytest
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from db import Database
+
+
+NOW = datetime.datetime.now(datetime.timezone.utc)
+HOUR = datetime.timedelta(hours=1)
+
+
+def block(db, height, *transitions):
+    # a block as the node returns it, with one accepted transaction per (function, inputs)
+    transactions = [dict(status='accepted', type='execute', transaction=dict(id=f'at1test{height}x{i}', execution=dict(transitions=[
+        dict(program=db.contract_name, function=function, finalize=inputs)]))) for i, (function, inputs) in enumerate(transitions)]
+    return dict(header=dict(metadata=dict(height=height, timestamp=int(NOW.timestamp()))), transactions=transactions)
+
+
+def match(db):
+    db.save_blocks([block(db, 10**9, ('sell', ['aleo1test', '5u64', '100u64']), ('buy', ['aleo1test', '3u64', '101u64']))])
+    db.match_orders({}, db.load_valid_orders({'addr': 'aleo1test'}))
+
+
+def record_transaction(db):
+    match(db)
+    db.record_transaction(db.load_trades(addr='aleo1test', limit=1)[0]['id'], 'at1test')
+
+
+def fill(conn):
+    # rows of a running exchange, mostly settled history, analyzed so the plans do not
+    # depend on the statistics earlier runs left: with the tables analyzed empty the
+    # planner prefers the primary keys to the partial indexes. The ids stay clear of
+    # the ones the sequences hand out.
+    conn.exec_driver_sql('''INSERT INTO "order" (id, type, side, quantity, origin_quantity, price, sum_price, addr, status, height, token_id, created_at, updated_at)
+        SELECT 1000000000 + i, 'limit', CASE WHEN mod(i, 2) = 0 THEN 'ask' ELSE 'bid' END, 0, 10, 90 + mod(i, 20), 0, 'aleo1fill' || mod(i, 500),
+               CASE WHEN mod(i, 50) = 0 THEN 'todo' ELSE 'done' END, i / 10, 1 + mod(i, 2), now() - i * interval '1 minute', now()
+        FROM generate_series(1, 5000) AS i''')
+    conn.exec_driver_sql('''INSERT INTO trade (id, party1_order_id, party2_order_id, price, quantity, token_id, created_at, updated_at, onchain, settlement)
+        SELECT 1000000000 + i, 1000000000 + i, 1000000000 + 5001 - i, 90 + mod(i, 20), 1, 1 + mod(i, 2), now() - i * interval '1 minute', now(), true, 'confirmed'
+        FROM generate_series(1, 5000) AS i''')
+    conn.exec_driver_sql('ANALYZE "order", trade')
+
+
+# Database calls on the hot paths and the indexes their plans must use, besides the
+# primary keys of joined rows; AsyncDatabase builds its queries with the same functions
+CALLS = {
+    'dealer reload': (lambda db: db.load_valid_orders({'status': 'todo', 'after_id': -1}), ['ix_order_todo_book']),
+    'orders by addr': (lambda db: db.load_valid_orders({'addr': 'aleo1'}, 100), ['ix_order_addr_id']),
+    'orders after id': (lambda db: db.load_valid_orders({'addr': 'aleo1', 'after_id': 10}, 100), ['ix_order_addr_id']),
+    'prices': (lambda db: db.load_prices('TK1-LEO'), ['ix_order_todo_book']),
+    'trades by addr': (lambda db: db.load_trades(addr='aleo1', limit=100), ['ix_order_addr_id', 'ix_trade_party1_order_id', 'ix_trade_party2_order_id']),
+    'trades by order': (lambda db: db.load_trades(order_id=1, limit=100), ['ix_trade_party1_order_id', 'ix_trade_party2_order_id']),
+    # polls for the latest trades, from the start of the test: past every trade the database holds
+    'trades by token': (lambda db: db.load_trades(token_id=1, tm_from=NOW, limit=100, after=10), ['ix_trade_token_created_at']),
+    'trades by symbol': (lambda db: db.load_trades(symbol='TK1-LEO', tm_from=NOW, limit=100), ['ix_trade_token_created_at']),
+    'summary': (lambda db: db.summary_trade('TK1-LEO'), ['ix_trade_token_created_at']),
+    'candles': (lambda db: db.load_candles('TK1-LEO', NOW - HOUR, NOW, '1Min'), ['candle_pkey']),
+    'history': (lambda db: db.load_history('TK1-LEO', NOW - HOUR, NOW, '1Min'), ['ix_trade_token_created_at']),
+    'height': (lambda db: db.get_db_height(), ['block_pkey']),
+    'last ids': (lambda db: db.get_last_ids(), ['order_pkey', 'trade_pkey']),
+    'last trade of orders': (lambda db: db.get_last_trade_id([1, 2]), ['ix_trade_party2_order_id']),
+    'match': (match, ['order_pkey']),
+    'pending trades': (lambda db: db.get_pending_trades(100), ['ix_trade_pending_id']),
+    'claim trades': (lambda db: db.submit_trades([1]), []),
+    'record transaction': (record_transaction, ['trade_pkey']),
+    'settle trades': (lambda db: db.settle_trades([1], [2]), []),
+    'requeue stale trades': (lambda db: db.requeue_stale_trades(datetime.timedelta(0), 0), ['ix_trade_submitted_at', 'block_pkey']),
+    'unsettled trades': (lambda db: db.count_unsettled_trades(), ['ix_trade_pending_id', 'ix_trade_submitted_at']),
+    'confirm knockdowns': (lambda db: db.save_blocks([block(db, 10**9 + 1, ('knockdown', []))]), ['knockdown_pkey', 'trade_pkey']),
+}
+
+
+@pytest.mark.parametrize('name', CALLS)
+def test_queries_use_indexes(psqlurl, name):
+    '''
+    Every statement of the call is explained with sequential scans disabled,
+    so the plan scans an index whenever one can serve it, however small the
+    tables are, and together the plans must scan the indexes listed for it.
+    Token lookups by symbol are left to the planner, the table holds one row
+    per market. All of it, the rows of fill included, runs in a transaction
+    rolled back at the end, the commits of the call only release savepoints.
+    '''
+    call, indexes = CALLS[name]
+    db = Database(psqlurl)
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(('SELECT', 'WITH', 'UPDATE')):
+            statements.append((statement, parameters))
+
+    with db.engine.connect() as conn:
+        transaction = conn.begin()
+        fill(conn)
+        db.session = Session(bind=conn, join_transaction_mode='create_savepoint')
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            call(db)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        assert statements
+        conn.exec_driver_sql('SET LOCAL enable_seqscan = off')
+        plans = []
+        for statement, parameters in statements:
+            plan = '\n'.join(conn.exec_driver_sql('EXPLAIN ' + statement, parameters).scalars())
+            assert 'Index' in plan and not [line for line in plan.splitlines() if 'Seq Scan' in line and 'Seq Scan on token' not in line], f'{statement}\n{plan}'
+            plans.append(plan)
+        transaction.rollback()
+    for index in indexes:
+        assert any(f' {index} ' in plan for plan in plans), (index, plans)
+    db.engine.dispose()
@@ -0,0 +1,227 @@
+import asyncio
+import os
+import random
+import numpy as np
+import pytest
+from matcher import LocalMatcher, match
+from recovery import INPUT, Journal, MatchState, dump_book, load_books, read_snapshot, write_snapshot
+
+
+def orders(start, count, token_id=1):
+    # alternating asks and bids around one price, so some of them cross
+    return [dict(trade_id=i, token_id=token_id, type='limit', side=('ask', 'bid')[i % 2], price=100 + i % 3, quantity=5 + i % 4)
+            for i in range(start, start + count)]
+
+
+def test_journal_round_trip(tmp_path):
+    path = str(tmp_path / 'orders.journal')
+    journal = Journal(path)
+    assert len(journal) == 0 and journal.read() == ([], [], None)
+    journal.append(orders(0, 3))
+    journal.commit(2, 7)
+    journal.append(orders(3, 2))
+    assert len(journal) == 6
+    assert Journal(path).read() == (orders(0, 3), orders(3, 2), 7)
+
+    journal.reset()
+    assert len(journal) == 0 and journal.read() == ([], [], None)
+    journal.append(orders(5, 1))
+    journal.commit(5, 8)
+    assert len(journal) == 2
+    assert Journal(path).read() == (orders(5, 1), [], 8)
+
+
+def test_journal_drops_torn_record(tmp_path):
+    path = str(tmp_path / 'orders.journal')
+    journal = Journal(path)
+    journal.append(orders(0, 2))
+    journal.commit(1, 3)
+    # a crash in the middle of the next write
+    with open(path, 'ab') as f:
+        f.write(b'\0' * (INPUT.itemsize // 2))
+    journal = Journal(path)
+    assert len(journal) == 3
+    assert journal.read() == (orders(0, 2), [], 3)
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / 'books.snapshot')
+    assert read_snapshot(path) is None
+    books = {}
+    match(books, orders(0, 20) + orders(20, 9, token_id=2))
+    write_snapshot(path, 28, 11, {1: 19}, {token_id: dump_book(book) for token_id, book in books.items()})
+
+    header, table, _ = read_snapshot(path)
+    assert header[['last_order_id', 'last_trade_id', 'books']].tolist() == (28, 11, 2)
+    assert dict(table[['token_id', 'version']].tolist()) == {1: 19, 2: -1}
+    loaded = load_books(path, {1, 2})
+    for token_id, book in books.items():
+        book_time, next_order_id, rows = dump_book(book)
+        assert dump_book(loaded[token_id])[:2] == (book_time, next_order_id)
+        assert np.array_equal(dump_book(loaded[token_id])[2], rows) and len(rows)
+    # books on the same orders match the next ones the same way
+    assert match(loaded, orders(29, 6)) == match(books, orders(29, 6))
+
+
+class Chain:
+    '''
+    The database as the dealer sees it: the orders synced from the blocks so
+    far, their quantity and status as save_matches left them, and the trades
+    it saved, with ids from 1 as the trade table gives them.
+    '''
+    def __init__(self):
+        self.orders = {}
+        self.trades = []
+
+    def sync(self, orders):
+        for o in orders:
+            self.orders[o['trade_id']] = dict(o, status='todo')
+
+    def get_last_ids(self):
+        return max(self.orders, default=-1), len(self.trades) or -1
+
+    def get_last_trade_id(self, order_ids):
+        return max((trade['id'] for trade in self.trades if trade['party2_order_id'] in order_ids), default=None)
+
+    def load_valid_orders(self, filter):
+        return [dict(o) for order_id, o in sorted(self.orders.items()) if o['status'] == 'todo' and order_id > filter['after_id']]
+
+    def save_matches(self, order_updates, trades):
+        for order_id, (quantity, status, _) in order_updates.items():
+            self.orders[order_id].update(quantity=quantity, status=status)
+        for trade in trades:
+            trade['id'] = len(self.trades) + 1
+            self.trades.append(dict(trade))
+
+
+class Crash(Exception):
+    pass
+
+
+def die():
+    raise Crash()
+
+
+class Dealer:
+    '''
+    The loop of dealer.run with MATCH_STATE_DIR, one pass per feed. A pass given
+    crash dies before that step: 'save' (its matches), 'commit' (its COMMITTED
+    record), 'journal reset' (after the snapshot that follows it) or 'restart'
+    (the next pass).
+    '''
+    def __init__(self, directory, chain, interval=3600):
+        self.state = MatchState(directory, interval)
+        self.matcher = LocalMatcher()
+        self.chain = chain
+
+    async def start(self):
+        self.restored = self.last_order_id, self.versions = await self.state.restore(self.matcher, self.chain)
+        await self.feed(self.chain.load_valid_orders({'status': 'todo', 'after_id': self.last_order_id}))
+
+    async def feed(self, orders, crash=None):
+        orders = [dict(o) for o in orders if o['trade_id'] > self.last_order_id]
+        self.state.append(orders)
+        order_updates, trades, _ = await self.matcher.match(orders)
+        self.trades = trades
+        if crash == 'save':
+            raise Crash()
+        self.chain.save_matches(order_updates, trades)
+        if crash == 'commit':
+            raise Crash()
+        self.state.commit(orders, trades)
+        for o in orders:
+            self.versions[o['token_id']] = o['trade_id']
+        if orders:
+            self.last_order_id = orders[-1]['trade_id']
+        if crash == 'journal reset':
+            self.state.interval = 0
+            self.state.journal.reset = die
+        await self.state.checkpoint(self.matcher, self.last_order_id, self.versions)
+        if crash == 'restart':
+            raise Crash()
+
+    async def books(self):
+        return {token_id: (book_time, next_order_id, rows.tolist()) for token_id, (book_time, next_order_id, rows) in (await self.matcher.dump()).items()}
+
+
+def passes(seed, count=8):
+    # orders of two books as the blocks bring them, ids in chain order
+    rand = random.Random(seed)
+    order_id, result = 0, []
+    for _ in range(count):
+        batch = []
+        for _ in range(rand.randint(5, 15)):
+            batch.append(dict(trade_id=order_id, token_id=rand.choice((1, 2)), type='limit', side=rand.choice(('ask', 'bid')),
+                              price=rand.randint(97, 103), quantity=rand.randint(1, 20)))
+            order_id += 1
+        result.append(batch)
+    return result
+
+
+async def run(directory, batches, chain=None, crash=None, at=4):
+    '''Feeds batches to a dealer, with pass at dying before the step crash and the dealer restarted after it.'''
+    chain = chain or Chain()
+    dealer = Dealer(directory, chain)
+    await dealer.start()
+    for i, batch in enumerate(batches):
+        chain.sync(batch)
+        if crash and i == at:
+            with pytest.raises(Crash):
+                await dealer.feed(batch, crash=crash)
+            crashed = dealer
+            dealer = Dealer(directory, chain)
+            await dealer.start()
+            dealer.crashed = crashed
+        else:
+            await dealer.feed(batch)
+    return dealer, chain
+
+
+@pytest.mark.parametrize('crash', ['save', 'commit', 'journal reset', 'restart'])
+def test_restore_matches_uninterrupted_run(tmp_path, crash):
+    '''
+    A dealer that dies in a pass, before its matches are saved, before its
+    COMMITTED record, between the snapshot after it and the journal reset, or
+    right after it, restores from the snapshot taken after the first pass and
+    the journal since: books, last order id and versions as a dealer that never
+    stopped has them, and the same trades saved, none lost or saved twice.
+    '''
+    batches = passes(seed=5)
+    expected, expected_chain = asyncio.run(run(str(tmp_path / 'expected'), batches))
+    dealer, chain = asyncio.run(run(str(tmp_path / 'state'), batches, crash=crash))
+
+    # the pass that died matched, so its trades were saved again or found saved
+    assert dealer.crashed.trades
+    assert dealer.restored[0] == batches[4][-1]['trade_id']
+    assert dealer.last_order_id == expected.last_order_id and dealer.versions == expected.versions
+    assert asyncio.run(dealer.books()) == asyncio.run(expected.books())
+    assert chain.trades == expected_chain.trades and chain.orders == expected_chain.orders
+
+
+@pytest.mark.parametrize('database', ['backup', 'other dealer'])
+def test_restore_replays_orders_when_files_do_not_fit(tmp_path, database):
+    '''
+    Files that do not fit the database, restored from a backup taken a pass
+    earlier or holding a trade the dealer did not write, are dropped, and the
+    books are replayed from its todo orders as without them.
+    '''
+    batches = passes(seed=5)
+    directory = str(tmp_path / 'state')
+    asyncio.run(run(directory, batches[:5]))
+    if database == 'backup':
+        _, chain = asyncio.run(run(str(tmp_path / 'backup'), batches[:4]))
+    else:
+        _, chain = asyncio.run(run(str(tmp_path / 'other'), batches[:5]))
+        chain.trades.append(dict(chain.trades[-1], id=len(chain.trades) + 1))
+
+    async def restore():
+        dealer = Dealer(directory, chain)
+        assert await dealer.state.restore(dealer.matcher, chain) == (-1, {})
+        assert not os.path.exists(dealer.state.snapshot_path) and len(dealer.state.journal) == 0
+        await dealer.start()
+        replayed = Dealer(str(tmp_path / 'replayed'), chain)
+        await replayed.start()
+        assert await dealer.books() == await replayed.books()
+        assert dealer.last_order_id == replayed.last_order_id == max(o['trade_id'] for o in chain.load_valid_orders({'after_id': -1}))
+
+    asyncio.run(restore())
@@ -0,0 +1,31 @@
+import datetime
+import random
+from decimal import Decimal
+from types import SimpleNamespace
+import pytest
+from db.db import _format_summary
+from ticker import Ticker
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_ticker_matches_scan(seed):
+    # random trade streams, with bursts, gaps around the 24h edge and repeated deliveries
+    rnd = random.Random(seed)
+    ticker = Ticker()
+    trades = []
+    now = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)
+    for _ in range(rnd.randint(1, 200)):
+        now += datetime.timedelta(seconds=rnd.choice([0, 1, 60, 3600, 7 * 3600, 30000, 90000]))
+        for _ in range(rnd.randint(0, 4)):
+            trade = dict(id=len(trades), created_at=now,
+                         price=rnd.choice([Decimal(rnd.randint(1, 200)), rnd.randint(1, 200)]),
+                         quantity=rnd.choice([float(rnd.randint(1, 1000)), rnd.randint(1, 1000)]))
+            trades.append(trade)
+            ticker.add(trade)
+            if rnd.random() < 0.1:
+                ticker.add(trade)
+        at = now + datetime.timedelta(seconds=rnd.choice([0, 10, 86399, 86400, 86401]))
+        window = [SimpleNamespace(price=Decimal(t['price']), quantity=float(t['quantity']))
+                  for t in trades if t['created_at'] >= at - datetime.timedelta(days=1)]
+        assert ticker.summary(at) == _format_summary(window)
+        now = max(now, at)
@@ -0,0 +1,74 @@
+import datetime
+from collections import deque
+from decimal import Decimal
+
+
+WINDOW = datetime.timedelta(days=1)
+
+
+class Ticker:
+    '''
+    Rolling 24h volume, quantity, high and low of one symbol (or of all of
+    them), fed with trades in id order as the dealer commits them.
+
+    Trades in the window are kept as one entry per timestamp, with their
+    quantity and notional summed. A matching pass stamps all of its trades
+    alike, so there is usually one entry per pass. The running totals are
+    Decimals, so expiring entries never leaves float drift behind. Two
+    monotonic deques keep the high and low candidates. Adding, expiring and
+    answering are all amortised O(1), and the answer equals a scan of the
+    trades with created_at >= now - 24h.
+    '''
+
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self.entries = deque() # [created_at, quantity, notional], oldest first
+        self.highs = deque() # (created_at, price), prices decreasing
+        self.lows = deque() # (created_at, price), prices increasing
+        self.quantity = Decimal(0)
+        self.notional = Decimal(0)
+        self.last_id = -1
+
+    def add(self, trade):
+        # seeding from the database may overlap with trades already on the bus
+        if trade['id'] <= self.last_id:
+            return
+        self.last_id = trade['id']
+        created_at = trade['created_at']
+        price = Decimal(trade['price'])
+        quantity = Decimal(trade['quantity'])
+        if self.entries and self.entries[-1][0] == created_at:
+            self.entries[-1][1] += quantity
+            self.entries[-1][2] += quantity * price
+        else:
+            self.entries.append([created_at, quantity, quantity * price])
+        self.quantity += quantity
+        self.notional += quantity * price
+        while self.highs and self.highs[-1][1] <= price:
+            self.highs.pop()
+        self.highs.append((created_at, price))
+        while self.lows and self.lows[-1][1] >= price:
+            self.lows.pop()
+        self.lows.append((created_at, price))
+
+    def expire(self, now):
+        cutoff = now - self.window
+        while self.entries and self.entries[0][0] < cutoff:
+            _, quantity, notional = self.entries.popleft()
+            self.quantity -= quantity
+            self.notional -= notional
+        while self.highs and self.highs[0][0] < cutoff:
+            self.highs.popleft()
+        while self.lows and self.lows[0][0] < cutoff:
+            self.lows.popleft()
+
+    def summary(self, now=None):
+        self.expire(now or datetime.datetime.now(datetime.timezone.utc))
+        if not self.entries:
+            return dict(volume_24h=0, high_24h=0, low_24h=0, quantity_24h=0)
+        return dict(
+            volume_24h=float(self.notional),
+            high_24h=self.highs[0][1],
+            low_24h=self.lows[0][1],
+            quantity_24h=float(self.quantity),
+        )